@@ -524,8 +524,17 @@ class DeviceDialog extends ModalDialog.ModalDialog {
         if (this._scanning) return;
         this._scanning = true;
         this._setStatus(_('Scanning\u2026'));
+        // Devices arrive as scan_result events while the scan runs; a later
+        // event for the same address replaces the earlier entry.
+        const found = new Map();
+        this._indicator._scanListener = msg => {
+            if (msg.event !== 'scan_result') return;
+            found.set(msg.device.address, msg.device);
+            this._renderDevices([...found.values()]);
+            this._setStatus(_('Scanning\u2026 found %d device(s).').format(found.size));
+        };
         try {
-            const [stdout] = await this._indicator._send('scan_devices');
+            const [stdout] = await this._indicator._send('scan_stream');
             const res = JSON.parse(stdout);
             const all = res.devices || [];
             this._renderDevices(all);
@@ -533,6 +542,7 @@ class DeviceDialog extends ModalDialog.ModalDialog {
         } catch (e) {
             this._setStatus(`${_('Scan error:')} ${e}`);
         } finally {
+            this._indicator._scanListener = null;
             this._scanning = false;
         }
     }
@@ -543,6 +553,7 @@ class DeviceDialog extends ModalDialog.ModalDialog {
     }
 
     close() {
+        this._indicator._scanListener = null;
         this._onClosed?.();
         super.close();
     }
@@ -121,6 +121,7 @@ class FruitTVIndicator extends PanelMenu.Button {
         this.add_child(this._panelIcon);
 
         this._powerStates = new Map();
+        this._unreachable = new Set();   // device ids whose daemon breaker is open
         this._devices = new Map();
 
         // Pre-populate selected device from config so we can preconnect on first open
@@ -135,6 +136,8 @@ class FruitTVIndicator extends PanelMenu.Button {
         } catch (_e) {}
 
         this._pollTimer = null;
+        this._subscribedId = null;
+        this._scanListener = null;   // set by DeviceDialog during scan_stream
         this._lastTitle = null;
         this._launchVerifyTimer = null;
 
@@ -152,6 +155,7 @@ class FruitTVIndicator extends PanelMenu.Button {
         this._daemonStdin = null;
         this._daemonStdout = null;
         this._pendingRequests = new Map();
+        this._menuRequests = new Set();   // ids cancelled when the menu closes
         this._cmdId = 0;
 
         this._buildMenu();
@@ -161,6 +165,7 @@ class FruitTVIndicator extends PanelMenu.Button {
                 this._refreshAppButtons();
             } else {
                 this._stopPolling();
+                this._cancelMenuRequests();
             }
         });
     }
@@ -645,7 +650,7 @@ class FruitTVIndicator extends PanelMenu.Button {
     async _validateFavorites() {
         if (!this._selectedId) return;
         try {
-            const [stdout] = await this._send('list_apps', this._selectedId);
+            const [stdout] = await this._sendForMenu(15000, 'list_apps', this._selectedId);
             const res = JSON.parse(stdout);
             const apps = res.apps || [];
             if (apps.length === 0) return;
@@ -682,6 +687,12 @@ class FruitTVIndicator extends PanelMenu.Button {
         this._remoteLight.opacity = isReady ? 255 : 0;
     }
 
+    // Grey out the remote while the daemon fails the device's commands fast.
+    _setRemoteReachable(isReachable) {
+        if (!this._remoteWidget) return;
+        this._remoteWidget.opacity = isReachable ? 255 : 128;
+    }
+
     _togglePower() {
         if (!this._selectedId) return;
         const state = this._powerStates.get(this._selectedId);
@@ -768,15 +779,25 @@ class FruitTVIndicator extends PanelMenu.Button {
         this._stopPolling();
         const state = this._powerStates.get(deviceId);
         this._setRemoteReady(state === 'on' || state === 'off');
+        this._setRemoteReachable(!this._unreachable.has(deviceId));
         this._startPolling();
         this._loadSelectedDeviceTint();
     }
 
     // --- Polling for metadata ---
+    // Metadata arrives as daemon push events once subscribe_metadata succeeds;
+    // the timer then only runs a slow safety poll (power LED, missed events).
     _startPolling() {
         if (this._pollTimer) return;
         this._pollMetadata();
-        this._pollTimer = GLib.timeout_add_seconds(GLib.PRIORITY_DEFAULT, 5, () => {
+        this._schedulePoll(5);
+        this._subscribeMetadata(this._selectedId);
+    }
+
+    _schedulePoll(seconds) {
+        if (this._pollTimer)
+            GLib.source_remove(this._pollTimer);
+        this._pollTimer = GLib.timeout_add_seconds(GLib.PRIORITY_DEFAULT, seconds, () => {
             this._pollMetadata();
             return GLib.SOURCE_CONTINUE;
         });
@@ -787,15 +808,47 @@ class FruitTVIndicator extends PanelMenu.Button {
             GLib.source_remove(this._pollTimer);
             this._pollTimer = null;
         }
+        if (this._subscribedId && this._daemon) {
+            this._send('unsubscribe_metadata', this._subscribedId).catch(() => {});
+            this._subscribedId = null;
+        }
+    }
+
+    async _subscribeMetadata(deviceId) {
+        if (!deviceId) return;
+        try {
+            const [stdout] = await this._send('subscribe_metadata', deviceId);
+            if (!this._pollTimer || this._selectedId !== deviceId) {
+                // Polling stopped or device switched while we were waiting.
+                this._send('unsubscribe_metadata', deviceId).catch(() => {});
+                return;
+            }
+            this._subscribedId = deviceId;
+            this._updateMetadata(JSON.parse(stdout).metadata);
+            this._schedulePoll(30);
+        } catch (e) {
+            log(`FruitTV-Remote: metadata push unavailable, polling instead: ${e}`);
+        }
     }
 
     async _pollMetadata() {
-        if (!this._selectedId) return;
+        const deviceId = this._selectedId;
+        if (!deviceId) return;
         try {
-            const [stdout] = await this._send('get_metadata', this._selectedId);
-            const res = JSON.parse(stdout);
-            this._updateMetadata(res);
-            this._updatePowerStatus(this._selectedId);
+            // One daemon round trip for both reads.
+            const [stdout] = await this._sendForMenu(5000, 'batch',
+                { id: 'metadata', cmd: 'get_metadata', args: [deviceId] },
+                { id: 'power', cmd: 'power_state', args: [deviceId] });
+            const [metadata, power] = JSON.parse(stdout).responses;
+            if (metadata.error) {
+                this._updateMetadata(null);
+                return;
+            }
+            this._updateMetadata(metadata.result);
+            if (power.error)
+                this._updatePowerStatus(deviceId);
+            else
+                this._updatePowerStatus(deviceId, Boolean(power.result.on));
         } catch (e) {
             this._updateMetadata(null);
         }
@@ -881,6 +934,10 @@ class FruitTVIndicator extends PanelMenu.Button {
     _handleResponse(line) {
         try {
             const msg = JSON.parse(line);
+            if (msg.event) {
+                this._handleEvent(msg);
+                return;
+            }
             const pending = this._pendingRequests.get(msg.id);
             if (!pending) return;
             this._pendingRequests.delete(msg.id);
@@ -895,6 +952,36 @@ class FruitTVIndicator extends PanelMenu.Button {
         }
     }
 
+    _handleEvent(msg) {
+        if (msg.event === 'metadata' && msg.device_id === this._subscribedId) {
+            if (msg.error) {
+                // Daemon could not re-subscribe; fall back to fast polling.
+                this._subscribedId = null;
+                if (this._pollTimer) this._schedulePoll(5);
+                return;
+            }
+            this._updateMetadata(msg.metadata);
+        } else if (msg.event === 'connection_status') {
+            if (msg.status === 'unreachable')
+                this._unreachable.add(msg.device_id);
+            else if (msg.status === 'ready')
+                this._unreachable.delete(msg.device_id);
+            if (msg.device_id !== this._selectedId)
+                return;
+            this._setRemoteReachable(!this._unreachable.has(msg.device_id));
+            // The daemon prewarmed (or re-established) the connection;
+            // refresh the power LED so the remote enables without a press.
+            if (msg.status === 'ready')
+                this._updatePowerStatus(msg.device_id);
+            else if (msg.status === 'unreachable') {
+                this._powerStates.set(msg.device_id, 'unavailable');
+                this._setRemoteReady(false);
+            }
+        } else if (msg.event === 'scan_result' || msg.event === 'scan_complete') {
+            this._scanListener?.(msg);
+        }
+    }
+
     _cleanupDaemon() {
         try { this._daemonStdin?.close(null); } catch (_e) {}
         this._daemonStdin = null;
@@ -904,21 +991,41 @@ class FruitTVIndicator extends PanelMenu.Button {
             pending.reject(new Error('Daemon process exited'));
         }
         this._pendingRequests = new Map();
+        this._menuRequests.clear();
+        this._subscribedId = null;
         this._daemon = null;
+        // Breaker state lived in the daemon; a new one starts closed.
+        this._unreachable.clear();
+        this._setRemoteReachable(true);
+        // The push subscription died with the daemon; poll at full rate.
+        if (this._pollTimer) this._schedulePoll(5);
     }
 
     // ── Command dispatch ───────────────────────────────────────────────
 
     async _send(command, ...extraArgs) {
+        return this._sendRequest(command, extraArgs);
+    }
+
+    // Menu-scoped request: the daemon drops it after deadlineMs, and it is
+    // cancelled outright when the menu closes (_cancelMenuRequests).
+    async _sendForMenu(deadlineMs, command, ...extraArgs) {
+        return this._sendRequest(command, extraArgs, { deadlineMs, menuScoped: true });
+    }
+
+    _sendRequest(command, extraArgs, { deadlineMs = null, menuScoped = false } = {}) {
         this._ensureDaemon();
         const id = String(++this._cmdId);
-        const payload = JSON.stringify({
+        const request = {
             id,
             cmd: command,
             args: extraArgs.filter(a => a !== null && a !== undefined),
-        }) + '\n';
+        };
+        if (deadlineMs !== null)
+            request.deadline_ms = deadlineMs;
+        const payload = JSON.stringify(request) + '\n';
 
-        return new Promise((resolve, reject) => {
+        const promise = new Promise((resolve, reject) => {
             this._pendingRequests.set(id, { resolve, reject });
             try {
                 this._daemonStdin.put_string(payload, null);
@@ -927,6 +1034,16 @@ class FruitTVIndicator extends PanelMenu.Button {
                 reject(e);
             }
         });
+        if (!menuScoped)
+            return promise;
+        this._menuRequests.add(id);
+        return promise.finally(() => this._menuRequests.delete(id));
+    }
+
+    _cancelMenuRequests() {
+        for (const id of this._menuRequests)
+            this._send('cancel', id).catch(() => {});
+        this._menuRequests.clear();
     }
 
     destroy() {
@@ -85,6 +85,7 @@ cp "${SCRIPT_DIR}/scripts/ftv_control.py"       "${HELPER_DIR}/ftv_control.py"
 cp "${SCRIPT_DIR}/scripts/ftv_setup.py"         "${HELPER_DIR}/ftv_setup.py"
 cp "${SCRIPT_DIR}/scripts/ftv_daemon.py"        "${HELPER_DIR}/ftv_daemon.py"
 cp "${SCRIPT_DIR}/scripts/ftv_color_fetcher.py" "${HELPER_DIR}/ftv_color_fetcher.py"
+cp "${SCRIPT_DIR}/scripts/ftv_discovery.py"     "${HELPER_DIR}/ftv_discovery.py"
 
 # Rewrite shebang to use the venv's Python so the script is self-contained
 sed -i "1s|.*|#!${VENV_PYTHON}|" "${HELPER_DIR}/ftv_control.py"
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+bench_protocol.py — Micro-benchmark for the ftv_daemon wire codecs.
+
+Encodes a representative mix of daemon traffic (d-pad requests, empty
+responses, metadata push events) and reads it back through an
+asyncio.StreamReader exactly as the daemon's read loop does, then prints
+messages per second for every codec available in this environment.
+
+Usage:
+    python3 bench_protocol.py [message_count]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ftv_daemon import _available_codecs  # noqa: E402
+
+SAMPLE_MESSAGES = [
+    {"id": "41", "cmd": "down", "args": ["AA:BB:CC:DD:EE:FF"]},
+    {"id": "41", "result": {}},
+    {"event": "metadata", "device_id": "AA:BB:CC:DD:EE:FF", "metadata": {
+        "device_state": "DeviceState.Playing",
+        "title": "Some Episode Title",
+        "artist": "",
+        "album": "",
+        "series": "Some Series S3E7",
+        "position": 1234,
+        "duration": 2700,
+        "app_id": "com.apple.TVWatchList",
+    }},
+]
+
+
+def bench_encode(codec, count):
+    msgs = SAMPLE_MESSAGES
+    n = len(msgs)
+    start = time.perf_counter()
+    for i in range(count):
+        codec.encode(msgs[i % n])
+    return count / (time.perf_counter() - start)
+
+
+async def bench_decode(codec, count):
+    payload = b"".join(codec.encode(SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)])
+                       for i in range(count))
+    reader = asyncio.StreamReader(limit=len(payload) + 1)
+    reader.feed_data(payload)
+    reader.feed_eof()
+    start = time.perf_counter()
+    decoded = 0
+    while True:
+        body = await codec.read(reader)
+        if body is None:
+            break
+        codec.decode(body)
+        decoded += 1
+    elapsed = time.perf_counter() - start
+    assert decoded == count, (decoded, count)
+    return count / elapsed, len(payload) / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    print(f"{'codec':10s} {'encode msg/s':>14s} {'decode msg/s':>14s} {'bytes/msg':>10s}")
+    for name, codec in _available_codecs().items():
+        enc = bench_encode(codec, count)
+        dec, size = asyncio.run(bench_decode(codec, count))
+        print(f"{name:10s} {enc:14,.0f} {dec:14,.0f} {size:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+bench_sweep.py — Benchmark for the ftv_discovery subnet sweep probe phase.
+
+Starts fake Companion/MRP responders on a handful of loopback addresses
+(127.77.0.x — Linux routes all of 127.0.0.0/8 to lo), sweeps the whole /24
+with the default concurrency and with a single probe in flight, and checks
+that exactly the fake responders were found.  Hosts without a responder
+refuse the connection at once, so this measures the sweep's own overhead;
+pass --silent CIDR (an unused range where connects time out) to measure the
+timeout-bound case a real LAN sweep hits.
+
+Only the TCP probe phase is timed: the unicast pyatv.scan that follows is
+bounded by SWEEP_SCAN_TIMEOUT and only touches the responders.
+
+Usage:
+    python3 bench_sweep.py [--silent 192.0.2.0/24]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ftv_discovery import (  # noqa: E402
+    SWEEP_CONCURRENCY, SWEEP_CONNECT_TIMEOUT, SWEEP_PORTS, probe_hosts, sweep_hosts,
+)
+
+FAKE_CIDR = "127.77.0.0/24"
+FAKE_RESPONDERS = {
+    "127.77.0.10": 49153,
+    "127.77.0.42": 49153,
+    "127.77.0.77": 49152,   # MRP-only (older tvOS)
+    "127.77.0.200": 49153,
+}
+
+
+async def _start_responders():
+    async def _accept(_reader, writer):
+        writer.close()
+
+    return [
+        await asyncio.start_server(_accept, host, port)
+        for host, port in FAKE_RESPONDERS.items()
+    ]
+
+
+async def _timed(hosts, concurrency):
+    start = time.perf_counter()
+    found = await probe_hosts(hosts, concurrency=concurrency)
+    return found, time.perf_counter() - start
+
+
+async def main():
+    silent = None
+    if "--silent" in sys.argv:
+        silent = sys.argv[sys.argv.index("--silent") + 1]
+
+    servers = await _start_responders()
+    try:
+        hosts = sweep_hosts(FAKE_CIDR)
+        print(f"fake harness: {len(hosts)} hosts, {len(FAKE_RESPONDERS)} responders, "
+              f"ports {SWEEP_PORTS}")
+        for concurrency in (SWEEP_CONCURRENCY, 1):
+            found, elapsed = await _timed(hosts, concurrency)
+            ok = dict(found) == FAKE_RESPONDERS
+            print(f"  concurrency {concurrency:4d}: {elapsed * 1000:8.1f} ms  "
+                  f"found {len(found)} {'(correct)' if ok else '(MISMATCH)'}")
+    finally:
+        for server in servers:
+            server.close()
+
+    if silent:
+        hosts = sweep_hosts(silent)
+        found, elapsed = await _timed(hosts, SWEEP_CONCURRENCY)
+        sequential = len(hosts) * SWEEP_CONNECT_TIMEOUT
+        print(f"silent {silent}: {len(hosts)} hosts in {elapsed * 1000:.0f} ms, "
+              f"found {len(found)} (one probe at a time would take ~{sequential:.0f} s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
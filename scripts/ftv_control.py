@@ -25,6 +25,8 @@ import json
 import os
 import sys
 
+from ftv_discovery import DiscoveryCache, to_config
+
 CONFIG_PATH = os.path.expanduser("~/.config/fruittv-remote/devices.json")
 
 
@@ -105,23 +107,32 @@ def _pick_first_nonempty(*values):
     return None
 
 
-async def build_config(entry):
-    """Scan for device and apply stored credentials."""
+async def build_config(entry, use_cache=True):
+    """Find device (discovery cache, else scan) and apply stored credentials.
+
+    Returns (config, cached): cached is True when the discovery cache answered.
+    """
     import pyatv
     from pyatv.const import Protocol
 
-    loop = asyncio.get_running_loop()
-    atvs = []
-    match = None
-    if entry.get("address"):
-        atvs = await pyatv.scan(loop, hosts=[entry["address"]], timeout=5)
-        match = next((a for a in atvs if a.identifier == entry["id"]), None)
-    if match is None:
-        atvs = await pyatv.scan(loop, identifier=entry["id"], timeout=5)
-        if atvs:
-            match = atvs[0]
-    if match is None:
-        return None
+    cache = DiscoveryCache()
+    cached = cache.get(entry["id"]) if use_cache else None
+    if cached is not None:
+        match = to_config(cached)
+    else:
+        loop = asyncio.get_running_loop()
+        atvs = []
+        match = None
+        if entry.get("address"):
+            atvs = await pyatv.scan(loop, hosts=[entry["address"]], timeout=5)
+            match = next((a for a in atvs if a.identifier == entry["id"]), None)
+        if match is None:
+            atvs = await pyatv.scan(loop, identifier=entry["id"], timeout=5)
+            if atvs:
+                match = atvs[0]
+        if match is None:
+            return None, False
+        cache.record([match])
 
     config = match
     if "credentials_mrp" in entry:
@@ -130,7 +141,30 @@ async def build_config(entry):
         config.set_credentials(Protocol.Companion, entry["credentials_companion"])
     if "credentials_airplay" in entry:
         config.set_credentials(Protocol.AirPlay, entry["credentials_airplay"])
-    return config
+    return config, cached is not None
+
+
+async def connect(config, entry, cached=False):
+    """pyatv.connect; a stale discovery-cache config is dropped and rescanned.
+
+    When a config that came from the cache fails at the transport level (the
+    device moved within the cache TTL), the entry is forgotten and the
+    connect retried once with a fresh scan.
+    """
+    import pyatv
+    from pyatv import exceptions as pe
+    loop = asyncio.get_running_loop()
+    try:
+        return await pyatv.connect(config, loop)
+    except (pe.ConnectionFailedError, pe.ConnectionLostError, pe.OperationTimeoutError,
+            OSError, asyncio.TimeoutError):
+        if not cached:
+            raise
+        DiscoveryCache().forget(entry["id"])
+    config, _cached = await build_config(entry, use_cache=False)
+    if config is None:
+        die(f"Device not found: {entry['id']}")
+    return await pyatv.connect(config, loop)
 
 
 # ── Commands ──────────────────────────────────────────────────────────────────
@@ -139,6 +173,7 @@ async def cmd_scan():
     import pyatv
     from pyatv.const import OperatingSystem
     found = await pyatv.scan(asyncio.get_running_loop(), timeout=5)
+    DiscoveryCache().record(found)
     # Filter to only include Apple TVs (tvOS devices)
     apple_tvs = [
         a for a in found
@@ -159,6 +194,7 @@ async def cmd_scan_devices():
     """Scan like cmd_scan but annotate each result with whether it's already configured."""
     import pyatv
     found = await pyatv.scan(asyncio.get_running_loop(), timeout=5)
+    DiscoveryCache().record(found)
     cfg = load_config()
     known_ids = {d["id"] for d in cfg.get("devices", [])}
     out({"devices": [
@@ -173,7 +209,10 @@ async def cmd_scan_devices():
 
 
 async def cmd_device_details(entry, selected_id):
-    config = await build_config(entry)
+    cached = DiscoveryCache().get(entry["id"])
+    config = None
+    if cached is None:
+        config, _cached = await build_config(entry)
     details = {
         "id": entry.get("id"),
         "name": entry.get("name") or entry.get("id"),
@@ -186,7 +225,9 @@ async def cmd_device_details(entry, selected_id):
         },
     }
 
-    if config is not None:
+    if cached is not None:
+        details.update({k: v for k, v in cached["device_info"].items() if v})
+    elif config is not None:
         details["address"] = _pick_first_nonempty(
             getattr(config, "address", None),
             details.get("address"),
@@ -216,14 +257,13 @@ async def cmd_device_details(entry, selected_id):
 
 
 async def cmd_status(entry):
-    import pyatv
     from pyatv.const import DeviceState
 
-    config = await build_config(entry)
+    config, cached = await build_config(entry)
     if config is None:
         die(f"Device not found: {entry['id']}")
 
-    atv = await pyatv.connect(config, asyncio.get_running_loop())
+    atv = await connect(config, entry, cached)
     try:
         p = await atv.metadata.playing()
         out({
@@ -239,14 +279,13 @@ async def cmd_status(entry):
 
 
 async def cmd_power_state(entry):
-    import pyatv
     from pyatv.const import PowerState
 
-    config = await build_config(entry)
+    config, cached = await build_config(entry)
     if config is None:
         die(f"Device not found: {entry['id']}")
 
-    atv = await pyatv.connect(config, asyncio.get_running_loop())
+    atv = await connect(config, entry, cached)
     try:
         out({"on": atv.power.power_state == PowerState.On})
     finally:
@@ -255,14 +294,13 @@ async def cmd_power_state(entry):
 
 async def cmd_get_metadata(entry):
     """Fast metadata poll: title, artist, album, series, position, duration."""
-    import pyatv
     from pyatv.const import DeviceState
 
-    config = await build_config(entry)
+    config, cached = await build_config(entry)
     if config is None:
         die(f"Device not found: {entry['id']}")
 
-    atv = await pyatv.connect(config, asyncio.get_running_loop())
+    atv = await connect(config, entry, cached)
     try:
         p = await atv.metadata.playing()
 
@@ -299,13 +337,12 @@ async def cmd_get_metadata(entry):
 
 async def cmd_get_artwork(entry):
     """Fetch album/cover art, write to temp file, return path."""
-    import pyatv
 
-    config = await build_config(entry)
+    config, cached = await build_config(entry)
     if config is None:
         die(f"Device not found: {entry['id']}")
 
-    atv = await pyatv.connect(config, asyncio.get_running_loop())
+    atv = await connect(config, entry, cached)
     try:
         artwork = await atv.metadata.artwork(width=160, height=160)
         if artwork is None or not artwork.bytes:
@@ -322,13 +359,12 @@ async def cmd_get_artwork(entry):
 
 async def cmd_keyboard_set(entry, text):
     """Send text to the Apple TV's current text field."""
-    import pyatv
 
-    config = await build_config(entry)
+    config, cached = await build_config(entry)
     if config is None:
         die(f"Device not found: {entry['id']}")
 
-    atv = await pyatv.connect(config, asyncio.get_running_loop())
+    atv = await connect(config, entry, cached)
     try:
         await atv.keyboard.text_set(text)
     finally:
@@ -336,13 +372,12 @@ async def cmd_keyboard_set(entry, text):
 
 
 async def cmd_list_apps(entry):
-    import pyatv
 
-    config = await build_config(entry)
+    config, cached = await build_config(entry)
     if config is None:
         die(f"Device not found: {entry['id']}")
 
-    atv = await pyatv.connect(config, asyncio.get_running_loop())
+    atv = await connect(config, entry, cached)
     try:
         apps = await atv.apps.app_list()
         out({"apps": [
@@ -354,13 +389,12 @@ async def cmd_list_apps(entry):
 
 
 async def cmd_launch_app(entry, bundle_id):
-    import pyatv
 
-    config = await build_config(entry)
+    config, cached = await build_config(entry)
     if config is None:
         die(f"Device not found: {entry['id']}")
 
-    atv = await pyatv.connect(config, asyncio.get_running_loop())
+    atv = await connect(config, entry, cached)
     try:
         await atv.apps.launch_app(bundle_id)
     finally:
@@ -371,11 +405,11 @@ async def cmd_remote(entry, command):
     """Send a RemoteControl or Power command."""
     import pyatv
 
-    config = await build_config(entry)
+    config, cached = await build_config(entry)
     if config is None:
         die(f"Device not found: {entry['id']}")
 
-    atv = await pyatv.connect(config, asyncio.get_running_loop())
+    atv = await connect(config, entry, cached)
     try:
         rc = atv.remote_control
         pw = atv.power
@@ -5,61 +5,284 @@ ftv_daemon.py — Persistent Fruit TV control daemon.
 Started once by the GNOME Shell extension; keeps pyatv connections alive so
 button presses don't pay a per-command scan + connect cost.
 
-Protocol (stdin → stdout, newline-delimited JSON):
+Protocol (stdin → stdout, newline-delimited JSON by default):
   Request:  {"id": "1", "cmd": "play_pause", "args": ["<device_id>"]}
+            optional "priority": "interactive" | "background"
+            optional "deadline_ms": N  (relative; expired work is dropped
+            or cancelled and answered with kind "expired")
+  Cancel:   {"id": "3", "cmd": "cancel", "args": ["<request id>"]}
+            the cancelled request is answered with kind "cancelled"
+  Hello:    {"id": "0", "cmd": "hello", "args": [["msgpack", "orjson", "json"]]}
+            optional first message; switches to length-prefixed msgpack
+            frames or the faster orjson codec (see "Wire codecs" below).
+            Wait for its response before sending anything else: later
+            bytes are read with the negotiated codec.
+  Batch:    {"id": "2", "cmd": "batch", "args": [<request>, <request>, ...]}
+         -> {"id": "2", "result": {"responses": [<response>, ...]}}
   Response: {"id": "1", "result": {}}
-         or {"id": "1", "error": "message"}
+         or {"id": "1", "error": "message", "kind": "transport"}
+            kind: "transport" | "protocol" | "unsupported" | "user_input"
+                  | "unreachable" | "cancelled" | "expired" | "dropped"
+            ("unreachable": the device's circuit breaker is open; the
+            command failed fast without touching the network)
+  Event:    {"event": "metadata", "device_id": "<device_id>", "metadata": {...}}
+            {"event": "connection_status", "device_id": "<device_id>",
+             "status": "connecting" | "ready" | "failed" | "disconnected"
+                       | "unreachable" | "idle"}
+            ("unreachable" carries "retry_in_ms"; "idle" means the
+            connection pool closed it and it reopens on next use)
+            {"event": "scan_result", "scan_id": 1, "device": {...}, "elapsed_ms": 180}
+            {"event": "scan_complete", "scan_id": 1, "devices": [...], "elapsed_ms": 5000}
+
+Events carry no "id"; they are written unsolicited, e.g. after a client has
+sent `subscribe_metadata` for a device, or while the selected device's
+connection is prewarmed at startup (FTV_PREWARM, FTV_PREWARM_EXTRA), or while
+a `scan_stream` request is running.
+
+At most FTV_MAX_IN_FLIGHT requests run at once (each batch sub-request
+counts as one); further requests queue, and stdin is not read while the
+queue is full.  Events may be dropped while the reader is slow; responses
+never are.  Requests already read when stdin closes are still answered.
 
 The daemon exits when stdin is closed (EOF).
 """
 
 import asyncio
+import collections
+import contextvars
 import json
+import math
 import os
+import random
+import struct
 import sys
+import time
+
+from ftv_discovery import (
+    SWEEP_PORTS, DeviceDirectory, DiscoveryCache, MdnsBrowser, extract_device_info,
+    file_signature, is_tvos, sweep, to_config,
+)
 
 CONFIG_PATH = os.path.expanduser("~/.config/fruittv-remote/devices.json")
 
+# Connection health: every KEEPALIVE_INTERVAL seconds each cached connection is
+# probed concurrently (a Companion round trip on the session, else a TCP
+# connect to its control port), and background reconnects with jittered
+# exponential backoff when a connection is lost.
+KEEPALIVE_INTERVAL = 30
+KEEPALIVE_TIMEOUT = 3
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+RECONNECT_MAX_ATTEMPTS = 8
+
+# Connection pool: at most FTV_MAX_CONNECTIONS live device connections; past
+# that the least recently used is closed.  Connections unused for
+# FTV_CONNECTION_IDLE seconds (0 = never) are closed by the keepalive loop.
+# The selected device, devices with queued or running commands and metadata
+# subscribers are pinned and never evicted.
+MAX_CONNECTIONS = int(os.environ.get("FTV_MAX_CONNECTIONS", "8"))
+CONNECTION_IDLE_TIMEOUT = float(os.environ.get("FTV_CONNECTION_IDLE", "600"))
+
+# Circuit breaker: after BREAKER_THRESHOLD consecutive connect failures a
+# device's commands fail fast with `device_unreachable` while the reconnect
+# loop probes it; the cooldown doubles per failed probe up to the maximum.
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 15.0
+BREAKER_MAX_COOLDOWN = 300.0
+
+# Error kinds, reported as "kind" on error responses.  Only transport errors
+# (the link to the device is broken) make _with_retry reconnect.
+ERROR_TRANSPORT = "transport"
+ERROR_PROTOCOL = "protocol"          # the device answered with a failure
+ERROR_UNSUPPORTED = "unsupported"    # the device/protocol can't do this
+ERROR_USER_INPUT = "user_input"      # bad arguments or unknown command
+ERROR_UNREACHABLE = "unreachable"    # breaker open: failed fast, nothing sent
+
+# Retry policy per device command: (attempts, deadline in seconds).  Failed
+# connects are retried for every command (nothing reached the device), but a
+# transport error while the command itself ran is retried only for
+# IDEMPOTENT_COMMANDS, since a key press or volume step may already have
+# taken effect.
+DEFAULT_RETRY_POLICY = (2, 10.0)
+RETRY_POLICIES = {
+    "power_state": (3, 10.0),
+    "get_volume": (3, 10.0),
+    "get_metadata": (3, 10.0),
+    "subscribe_metadata": (3, 10.0),
+    "get_artwork": (3, 15.0),
+    "list_apps": (3, 15.0),
+}
+IDEMPOTENT_COMMANDS = {
+    "power_state", "get_volume", "set_volume", "volume_mute",
+    "get_metadata", "subscribe_metadata", "get_artwork", "list_apps",
+    "launch_app", "keyboard_set", "power_on", "power_off", "status_all",
+}
+
+# Prewarming: open the selected device's connection at startup and on
+# select_device, and optionally up to FTV_PREWARM_EXTRA recently used others.
+PREWARM = os.environ.get("FTV_PREWARM", "true").lower() == "true"
+PREWARM_EXTRA = int(os.environ.get("FTV_PREWARM_EXTRA", "0"))
+RECENT_DEVICES_LIMIT = 32   # MRU device ids remembered for PREWARM_EXTRA
+
+# Streaming scans (scan_stream) browse only the protocols the remote uses.
+# MRP and AirPlay stay in the default set so device identifiers match the ones
+# a full pyatv.scan reports (pyatv prefers their ids over Companion's).
+SCAN_PROTOCOLS = ("mrp", "airplay", "companion")
+SCAN_TIMEOUT = 5
+
+# Passive mDNS listener (opt-in): keeps a live DeviceDirectory of announced
+# devices so scans, device details and reconnects need no active scan, and
+# devices.json addresses/ports follow DHCP changes as soon as they are seen.
+MDNS_LISTENER = os.environ.get("FTV_MDNS_LISTENER", "false").lower() == "true"
+
+REMOTE_COMMANDS = {
+    "play_pause", "stop", "volume_up", "volume_down",
+    "skip_next", "skip_prev", "next_track", "prev_track",
+    "select", "select_hold", "up", "down", "left", "right",
+    "menu", "home", "top_menu",
+    "power_on", "power_off",
+}
+
+# Commands that talk to a device over its cached connection.  These run in a
+# per-device FIFO lane so presses reach the Apple TV in the order sent.
+DEVICE_COMMANDS = REMOTE_COMMANDS | {
+    "power_state", "get_volume", "set_volume", "volume_mute",
+    "get_metadata", "subscribe_metadata", "get_artwork",
+    "list_apps", "launch_app", "keyboard_set",
+}
+
+# Per-device caches (_BoundedCache): LRU size caps and TTLs.  A pairing
+# session the user walked away from is closed once PAIRING_TTL passes.
+DETAILS_CACHE_SIZE = 64
+DETAILS_CACHE_TTL = 6 * 3600
+CONN_LOCKS_SIZE = 64
+PAIRING_SESSIONS = 4
+PAIRING_TTL = 300
+
+# Admission control: requests read from stdin wait in a bounded queue and at
+# most FTV_MAX_IN_FLIGHT run at once.  When the queue is full the daemon stops
+# reading stdin, so backpressure reaches the client through the pipe.
+MAX_IN_FLIGHT = int(os.environ.get("FTV_MAX_IN_FLIGHT", "32"))
+ADMISSION_QUEUE_LIMIT = 256
+SHUTDOWN_GRACE = 5.0   # seconds to finish admitted requests after stdin EOF
+
+# Output: bytes buffered for stdout beyond which events are dropped and
+# request workers wait for the client to catch up.
+WRITE_HIGH_WATER = 256 * 1024
+
+# Largest msgpack frame accepted; a bigger length prefix is answered with an
+# error instead of being read (usually JSON sent before the hello reply).
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+# Span tracing (opt-in, or toggled with the `trace` command): one Chrome trace
+# event per request stage, appended to FTV_TRACE_PATH and rotated at
+# TRACE_MAX_BYTES.  scripts/ftv_trace.py ranks the slowest requests and stages.
+TRACE = os.environ.get("FTV_TRACE", "false").lower() == "true"
+TRACE_PATH = os.path.expanduser(
+    os.environ.get("FTV_TRACE_PATH", "~/.config/fruittv-remote/trace.json"))
+TRACE_MAX_BYTES = 8 * 1024 * 1024
+TRACE_BACKUPS = 2
+
+# Diagnostics: profile_start/profile_stop run cProfile over live traffic and
+# dump pstats to PROFILE_PATH (stopping by themselves after
+# PROFILE_MAX_SECONDS); memory_report starts tracemalloc on first use, or at
+# launch with FTV_TRACEMALLOC=true so early allocations are attributed too.
+PROFILE_PATH = os.path.expanduser("~/.config/fruittv-remote/daemon.pstats")
+PROFILE_MAX_SECONDS = 600
+PROFILE_TOP = 20
+TRACEMALLOC = os.environ.get("FTV_TRACEMALLOC", "false").lower() == "true"
+MEMORY_TOP = 15
+
+# Request priority classes.  Clients may send {"priority": "..."} explicitly;
+# otherwise BACKGROUND_COMMANDS default to background and the rest are
+# interactive.  Interactive work jumps ahead of queued background work.
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND)
+BACKGROUND_COMMANDS = {
+    "power_state", "get_volume", "get_metadata", "subscribe_metadata",
+    "get_artwork", "list_apps", "device_details", "scan_devices", "scan_stream",
+    "sweep_devices", "status_all",
+}
+
+# Idempotent setters where only the newest value matters (latest-wins).
+COALESCED_COMMANDS = {"set_volume", "set_config_value", "select_device"}
+COALESCED_RESULT = {"coalesced": True}
+
+# Fan-out (multi): connections to every target are prepared concurrently,
+# then each device's command is released from one barrier so the presses
+# leave within a single loop iteration.  Targets are a list of device ids or
+# the name of a group in devices.json ({"groups": {"name": [ids]}}).
+MULTI_PREPARE_TIMEOUT = 10
+MULTI_BARRIER_TIMEOUT = 2   # longest wait for busy device lanes to reach it
+
+# status_all: power, volume and now-playing for every configured device, at
+# most STATUS_CONCURRENCY devices at a time, each within STATUS_TIMEOUT
+# seconds.  A device that fails or times out is answered from the last good
+# status (with its age).
+STATUS_CONCURRENCY = 8
+STATUS_TIMEOUT = 3.0
+STATUS_CACHE_SIZE = 256
+
 
 # ── Config helpers ─────────────────────────────────────────────────────────────
 
-def load_config():
-    if not os.path.exists(CONFIG_PATH):
+def load_config(path=CONFIG_PATH):
+    if not os.path.exists(path):
         return {"devices": [], "selected": None}
     try:
-        with open(CONFIG_PATH) as f:
+        with open(path) as f:
             return json.load(f)
     except (json.JSONDecodeError, OSError):
         return {"devices": [], "selected": None}
 
 
-def save_config(cfg):
-    with open(CONFIG_PATH + ".tmp", "w") as f:
+def save_config(cfg, path=CONFIG_PATH):
+    with open(path + ".tmp", "w") as f:
         json.dump(cfg, f, indent=2)
-    os.rename(CONFIG_PATH + ".tmp", CONFIG_PATH)
+    os.rename(path + ".tmp", path)
 
 
-def find_device(cfg, device_id):
-    for dev in cfg.get("devices", []):
-        if dev["id"] == device_id:
-            return dev
-    return None
+class ConfigStore:
+    """Single parsed copy of devices.json with a device-id index.
 
+    The file is re-read only when its (mtime, inode, size) signature changes,
+    so edits made by ftv_setup.py or ftv_control.py are still picked up.
+    Writes go through save(), which refreshes the in-memory copy directly;
+    callers mutate the dict returned by get() and then pass it to save().
+    """
 
-def _normalize_os_name(value):
-    if value is None:
-        return None
-    text = str(value)
-    if "." in text:
-        text = text.split(".")[-1]
-    return text
+    def __init__(self, path=CONFIG_PATH):
+        self._path = path
+        self._cfg = None
+        self._sig = None
+        self._index = {}
 
+    def _reindex(self):
+        self._index = {d["id"]: d for d in self._cfg.get("devices", [])}
 
-def _pick_first_nonempty(*values):
-    for value in values:
-        if value is not None and str(value) != "":
-            return str(value)
-    return None
+    def get(self):
+        sig = file_signature(self._path)
+        if self._cfg is None or sig != self._sig:
+            self._cfg = load_config(self._path)
+            self._sig = sig
+            self._reindex()
+        return self._cfg
+
+    def find(self, device_id):
+        self.get()
+        return self._index.get(device_id)
+
+    def save(self, cfg):
+        try:
+            save_config(cfg, self._path)
+        except Exception:
+            # The caller may already have mutated the cached copy.
+            self._cfg = None
+            raise
+        self._cfg = cfg
+        self._sig = file_signature(self._path)
+        self._reindex()
 
 
 def _extract_service_ports(config):
@@ -124,55 +347,1164 @@ def _build_manual_config(entry):
     return config
 
 
-def _extract_device_info(config):
-    """Extract network-discovered device info from a pyatv config object."""
-    result = {
-        "address": str(getattr(config, "address", "") or ""),
+async def _race_discovery(identifier, address=None, any_at_host=False, timeout=5):
+    """Locate a device with concurrent scans; return (config, path).
+
+    Races a unicast scan of the last known address against a multicast scan
+    for the identifier, takes the first valid match and cancels the other.
+    `path` names the scan that won ("host" or "identifier"), or is None when
+    neither found the device.  With any_at_host, whatever answers at the
+    address is accepted even if its identifier differs (used by pairing,
+    where the id may be an IP placeholder).
+    """
+    import pyatv
+    loop = asyncio.get_running_loop()
+
+    async def _host_scan():
+        atvs = await pyatv.scan(loop, hosts=[address], timeout=timeout)
+        match = next((a for a in atvs if identifier in a.all_identifiers), None)
+        if match is None and any_at_host and atvs:
+            match = atvs[0]
+        return match
+
+    async def _identifier_scan():
+        atvs = await pyatv.scan(loop, identifier=identifier, timeout=timeout)
+        return atvs[0] if atvs else None
+
+    tasks = {loop.create_task(_identifier_scan()): "identifier"}
+    if address:
+        tasks[loop.create_task(_host_scan())] = "host"
+    try:
+        while tasks:
+            done, _pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                path = tasks.pop(task)
+                if task.exception() is not None:
+                    print(f"[discovery] {path} scan for {identifier} failed: {task.exception()}",
+                          file=sys.stderr, flush=True)
+                elif task.result() is not None:
+                    return task.result(), path
+        return None, None
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _scan_protocols(names):
+    """Map protocol names ("mrp", "companion", ...) to a set of pyatv Protocols."""
+    from pyatv.const import Protocol
+    by_name = {p.name.lower(): p for p in Protocol}
+    unknown = [str(n) for n in names if str(n).lower() not in by_name]
+    if unknown:
+        raise ValueError(f"Unknown protocol(s): {', '.join(unknown)}")
+    return {by_name[str(n).lower()] for n in names}
+
+
+def _is_apple_tv(config):
+    from pyatv.const import OperatingSystem
+    return bool(config.device_info) and config.device_info.operating_system == OperatingSystem.TvOS
+
+
+def _scan_entry(config, known_ids):
+    """Convert a pyatv scan result into a scan_devices device dict."""
+    return {
+        "name":    str(config.name),
+        "id":      config.identifier,
+        "address": str(config.address),
+        "known":   not known_ids.isdisjoint(config.all_identifiers),
     }
-    info = getattr(config, "device_info", None)
-    if info is not None:
-        result["model"] = _pick_first_nonempty(
-            getattr(info, "model_str", None),
-            getattr(info, "model", None),
-        )
-        result["operating_system"] = _normalize_os_name(
-            getattr(info, "operating_system", None)
-        )
-        result["os_version"] = _pick_first_nonempty(
-            getattr(info, "version", None),
-            getattr(info, "operating_system_version", None),
-        )
-        result["build_number"] = _pick_first_nonempty(
-            getattr(info, "build_number", None)
-        )
-        result["mac"] = _pick_first_nonempty(
-            getattr(info, "mac", None),
-            getattr(info, "mac_address", None),
+
+
+def _cached_scan_entry(ident, entry, known_ids):
+    """Convert a discovery cache/directory entry into a scan_devices device dict."""
+    return {
+        "name":    entry["name"],
+        "id":      ident,
+        "address": entry["address"],
+        "known":   not known_ids.isdisjoint(entry["identifiers"]),
+    }
+
+
+def _format_playing(p):
+    """Convert a pyatv Playing object into the get_metadata result dict."""
+    series = ""
+    sn = getattr(p, "series_name", None)
+    if sn:
+        series = sn
+        season  = getattr(p, "season_number",  None)
+        episode = getattr(p, "episode_number", None)
+        if season is not None and episode is not None:
+            series += f" S{season}E{episode}"
+        elif episode is not None:
+            series += f" E{episode}"
+    duration = getattr(p, "total_time", None) or getattr(p, "duration", None)
+    app = getattr(p, "app", None)
+    app_id = app.identifier if (app and hasattr(app, "identifier")) else None
+    return {
+        "device_state": str(p.device_state),
+        "title":    p.title  or "",
+        "artist":   p.artist or "",
+        "album":    p.album  or "",
+        "series":   series,
+        "position": p.position,
+        "duration": duration,
+        "app_id":   app_id,
+    }
+
+
+class _MetadataListener:
+    """pyatv PushListener that forwards now-playing changes to the daemon.
+
+    pyatv only keeps a weak reference to its listener, so the daemon holds
+    these objects in `_metadata_subs` for as long as a subscription exists.
+    """
+
+    def __init__(self, daemon, device_id):
+        self._daemon = daemon
+        self._device_id = device_id
+
+    def playstatus_update(self, updater, playstatus):
+        self._daemon._on_playstatus(self._device_id, _format_playing(playstatus))
+
+    def playstatus_error(self, updater, exception):
+        self._daemon._on_playstatus_error(self._device_id, exception)
+
+
+class _DeviceListener:
+    """pyatv DeviceListener that reports unexpected disconnects.
+
+    Like _MetadataListener, held strongly by the daemon (`_device_listeners`)
+    because pyatv only keeps a weak reference.
+    """
+
+    def __init__(self, daemon, device_id, atv):
+        self._daemon = daemon
+        self._device_id = device_id
+        self._atv = atv
+
+    def connection_lost(self, exception):
+        self._daemon._on_connection_lost(self._device_id, self._atv, exception)
+
+    def connection_closed(self):
+        self._daemon._on_connection_lost(self._device_id, self._atv, None)
+
+
+def _probe_target(config):
+    """Return (address, port) of the control service used for keepalives."""
+    from pyatv.const import Protocol
+    for protocol in (Protocol.Companion, Protocol.MRP):
+        svc = config.get_service(protocol)
+        if svc is not None and svc.port:
+            return str(config.address), svc.port
+    return None
+
+
+def _health_counters():
+    return {
+        "lost": 0, "reconnects": 0, "reconnect_failures": 0,
+        "last_reconnect_ms": None, "total_reconnect_ms": 0.0,
+    }
+
+
+class DeviceUnreachable(ConnectionError):
+    """Raised without touching the network while a device's breaker is open."""
+
+    kind = ERROR_UNREACHABLE
+
+    def __init__(self, device_id, retry_in):
+        super().__init__(f"device_unreachable: {device_id} (retry in {math.ceil(retry_in)}s)")
+
+
+class _CircuitBreaker:
+    """Per-device connect breaker: closed -> open -> half_open -> closed.
+
+    While open, allow() refuses until the cooldown has passed; it then lets a
+    single trial connect through (half_open).  Any success closes it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.retry_at = 0.0
+
+    def retry_in(self):
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.retry_in() == 0:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def success(self):
+        """Record a connect; return True when this closed an open breaker."""
+        was_closed = self.state == self.CLOSED
+        self.state, self.failures, self.trips = self.CLOSED, 0, 0
+        return not was_closed
+
+    def abandon(self):
+        """A trial connect was cancelled: reopen so the next allow() retries."""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+    def failure(self):
+        """Record a failed connect; return True when this opened the breaker."""
+        self.failures += 1
+        if self.state == self.CLOSED and self.failures < BREAKER_THRESHOLD:
+            return False
+        opened = self.state == self.CLOSED
+        self.trips += 1
+        cooldown = min(BREAKER_MAX_COOLDOWN, BREAKER_COOLDOWN * 2 ** (self.trips - 1))
+        self.state = self.OPEN
+        self.retry_at = time.monotonic() + cooldown
+        return opened
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_in_ms": round(self.retry_in() * 1000) if self.state != self.CLOSED else 0,
+        }
+
+
+def _coalesce_key(cmd, args):
+    """Requests with the same key overwrite each other while one is in flight."""
+    if cmd == "select_device":
+        return (cmd,)
+    if cmd == "set_config_value":
+        return (cmd, args[0] if args else None, args[1] if len(args) > 1 else None)
+    return (cmd, args[0] if args else None)
+
+
+class _Coalescer:
+    """Latest-wins stage for idempotent setters.
+
+    At most one request per key runs at a time.  While it is in flight only
+    the newest follower is kept; the follower it replaces is answered with
+    COALESCED_RESULT without ever reaching the device.
+    """
+
+    def __init__(self):
+        self._pending = {}   # key -> (coroutine factory, future)
+        self._busy = set()   # keys with a running drain task
+
+    def submit(self, key, fn):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        superseded = self._pending.pop(key, None)
+        if superseded is not None and not superseded[1].done():
+            superseded[1].set_result(COALESCED_RESULT)
+        self._pending[key] = (fn, fut)
+        if key not in self._busy:
+            self._busy.add(key)
+            loop.create_task(self._drain(key))
+        return fut
+
+    async def _drain(self, key):
+        try:
+            while key in self._pending:
+                fn, fut = self._pending.pop(key)
+                if fut.done():
+                    continue   # cancelled or expired while waiting
+                try:
+                    result = await fn()
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    if not fut.done():
+                        fut.set_result(result)
+        finally:
+            self._busy.discard(key)
+
+
+class RequestDropped(Exception):
+    """A queued background request was shed because its lane is backed up."""
+
+    kind = "dropped"
+
+
+class RequestCancelled(Exception):
+    """The client sent `cancel` for this request."""
+
+    kind = "cancelled"
+
+
+class RequestExpired(Exception):
+    """The request's deadline_ms passed before it finished."""
+
+    kind = "expired"
+
+
+class CommandFailed(Exception):
+    """A command error carrying an explicit ERROR_* kind."""
+
+    def __init__(self, message, kind):
+        super().__init__(message)
+        self.kind = kind
+
+
+def _classify_error(exc):
+    """Return the ERROR_* kind for an exception raised by a command."""
+    kind = getattr(exc, "kind", None)
+    if kind is not None:
+        return kind
+    from pyatv import exceptions as pe
+    if isinstance(exc, (NotImplementedError, pe.UnsupportedProtocolError, pe.NoServiceError)):
+        return ERROR_UNSUPPORTED
+    # The only failures that mean the link itself is gone.  OSError covers
+    # ConnectionError (resets, refusals, our own "not found on network") and
+    # EOFError covers asyncio.IncompleteReadError.
+    if isinstance(exc, (
+        pe.ConnectionLostError, pe.ConnectionFailedError, pe.OperationTimeoutError,
+        OSError, asyncio.TimeoutError, EOFError,
+    )):
+        return ERROR_TRANSPORT
+    if isinstance(exc, (
+        pe.ProtocolError, pe.CommandError, pe.InvalidResponseError, pe.BackOffError,
+        pe.AuthenticationError, pe.InvalidCredentialsError, pe.NoCredentialsError,
+        pe.PlaybackError, pe.InvalidStateError, pe.BlockedStateError, pe.HttpError,
+    )):
+        return ERROR_PROTOCOL
+    if isinstance(exc, (ValueError, TypeError, KeyError, IndexError)):
+        return ERROR_USER_INPUT
+    # Anything else (AttributeError, RuntimeError, ...) is a failure of this
+    # command, not of the link: keep the connection and don't retry.
+    return ERROR_PROTOCOL
+
+
+class _Lane:
+    def __init__(self):
+        self.interactive = collections.deque()  # (fn, [waiter futures])
+        self.background = collections.deque()   # (fn, [waiter futures], key)
+        self.wakeup = asyncio.Event()
+        self.running = False      # an interactive job is executing
+        self.bg_running = False   # a background job is executing
+
+
+class _LaneScheduler:
+    """One ordered lane per device_id, with two priority classes.
+
+    Interactive jobs run strictly one after another in arrival order.
+    Background jobs only start when no interactive job is queued, run at most
+    one at a time per lane, and are not awaited by the lane worker, so a slow
+    `list_apps` never holds up a d-pad press queued behind it.  Identical
+    queued background requests share one result, and when more than
+    BACKGROUND_QUEUE_LIMIT are waiting the oldest is dropped.
+
+    Every caller gets its own future.  A job whose callers have all gone
+    (request cancelled or expired) is skipped if still queued, and cancelled
+    if already running, so abandoned work stops holding the device.
+
+    Different lanes (and work submitted without a lane) run concurrently.  A
+    lane's worker task exits once it drains, so idle devices cost nothing.
+    """
+
+    BACKGROUND_QUEUE_LIMIT = 4
+
+    def __init__(self):
+        self._lanes = {}   # lane_id -> _Lane
+
+    def submit(self, lane_id, fn, priority=PRIORITY_INTERACTIVE, key=None):
+        loop = asyncio.get_running_loop()
+        lane = self._lanes.get(lane_id)
+        if lane is None:
+            lane = self._lanes[lane_id] = _Lane()
+            loop.create_task(self._worker(lane_id, lane))
+
+        fut = loop.create_future()
+        if priority == PRIORITY_BACKGROUND:
+            if key is not None:
+                for _fn, waiters, queued_key in lane.background:
+                    if queued_key == key:
+                        waiters.append(fut)
+                        return fut
+            lane.background.append((fn, [fut], key))
+            if len(lane.background) > self.BACKGROUND_QUEUE_LIMIT:
+                _fn, dropped, _key = lane.background.popleft()
+                for waiter in dropped:
+                    if not waiter.done():
+                        waiter.set_exception(RequestDropped(
+                            f"dropped: too many background requests queued for '{lane_id}'"
+                        ))
+        else:
+            lane.interactive.append((fn, [fut]))
+        lane.wakeup.set()
+        return fut
+
+    @staticmethod
+    async def _run_job(fn, waiters):
+        if all(w.done() for w in waiters):
+            return   # every caller cancelled or expired while it was queued
+        job = asyncio.get_running_loop().create_task(fn())
+
+        def _abandon(_fut):
+            if all(w.done() for w in waiters):
+                job.cancel()
+
+        for waiter in waiters:
+            waiter.add_done_callback(_abandon)
+        await asyncio.wait({job})
+        exc = None if job.cancelled() else job.exception()
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if job.cancelled():
+                waiter.cancel()
+            elif exc is not None:
+                waiter.set_exception(exc)
+            else:
+                waiter.set_result(job.result())
+
+    async def _run_background(self, lane, fn, waiters):
+        try:
+            await self._run_job(fn, waiters)
+        finally:
+            lane.bg_running = False
+            lane.wakeup.set()
+
+    async def _worker(self, lane_id, lane):
+        loop = asyncio.get_running_loop()
+        try:
+            while lane.interactive or lane.background or lane.bg_running:
+                lane.wakeup.clear()
+                if lane.interactive:
+                    fn, waiters = lane.interactive.popleft()
+                    lane.running = True
+                    try:
+                        await self._run_job(fn, waiters)
+                    finally:
+                        lane.running = False
+                elif lane.background and not lane.bg_running:
+                    fn, waiters, _key = lane.background.popleft()
+                    lane.bg_running = True
+                    loop.create_task(self._run_background(lane, fn, waiters))
+                else:
+                    await lane.wakeup.wait()
+        finally:
+            del self._lanes[lane_id]
+
+    def busy(self, lane_id):
+        """True while the lane has queued or running work."""
+        return lane_id in self._lanes
+
+    def depths(self):
+        """Return per-lane queue depths for active lanes."""
+        return {
+            lane_id: {
+                "queued": len(lane.interactive) + len(lane.background),
+                "interactive": len(lane.interactive),
+                "background": len(lane.background),
+                "running": lane.running or lane.bg_running,
+            }
+            for lane_id, lane in self._lanes.items()
+        }
+
+
+class _BoundedCache:
+    """Small LRU map with optional TTL and a close hook for evicted values.
+
+    Entries beyond max_size (least recently used first) and entries older
+    than ttl are evicted; on_evict(key, value) is called for each, and for a
+    value replaced by a different one, so handles get closed.  A hook may
+    return a coroutine, which is run in the background.  keep(key, value)
+    can veto an eviction (e.g. a lock that is held), so the cache may run
+    over max_size while entries are in use.  pop() hands ownership
+    back to the caller without calling the hook.
+    """
+
+    def __init__(self, max_size, ttl=None, on_evict=None, keep=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._on_evict = on_evict
+        self._keep = keep
+        self._data = collections.OrderedDict()   # key -> (value, stored at)
+        self._closing = set()                    # background close tasks
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def _expired(self, stored):
+        return self.ttl is not None and time.monotonic() - stored > self.ttl
+
+    def _close(self, key, value):
+        if self._on_evict is None:
+            return
+        try:
+            result = self._on_evict(key, value)
+        except Exception as e:
+            print(f"[cache] closing {key}: {e}", file=sys.stderr, flush=True)
+            return
+        if asyncio.iscoroutine(result):
+            task = asyncio.get_running_loop().create_task(self._close_async(key, result))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _close_async(key, coro):
+        try:
+            await coro
+        except Exception as e:
+            print(f"[cache] closing {key}: {e}", file=sys.stderr, flush=True)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None and self._expired(item[1]):
+            self.discard(key)
+            self.expirations += 1
+            item = None
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return item[0]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __setitem__(self, key, value):
+        old = self._data.pop(key, None)
+        if old is not None and old[0] is not value:
+            self._close(key, old[0])
+        self._data[key] = (value, time.monotonic())
+        self.prune()
+
+    def get_or_create(self, key, factory):
+        value = self.get(key)
+        if value is None:
+            value = self[key] = factory()
+        return value
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def discard(self, key):
+        """Remove key, running the close hook."""
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._close(key, item[0])
+
+    def prune(self):
+        """Evict expired entries, then LRU entries beyond max_size."""
+        if self.ttl is not None:
+            for key, (value, stored) in list(self._data.items()):
+                if self._expired(stored) and not (self._keep and self._keep(key, value)):
+                    del self._data[key]
+                    self._close(key, value)
+                    self.expirations += 1
+        over = len(self._data) - self.max_size
+        # The newest entry always stays: it was just handed to a caller.
+        for key, (value, _stored) in list(self._data.items())[:-1]:
+            if over <= 0:
+                break
+            if self._keep and self._keep(key, value):
+                continue
+            del self._data[key]
+            self._close(key, value)
+            self.evictions += 1
+            over -= 1
+
+    def stats(self):
+        return {
+            "size": len(self._data), "max_size": self.max_size,
+            "hits": self.hits, "misses": self.misses,
+            "evictions": self.evictions, "expirations": self.expirations,
+        }
+
+
+class _Barrier:
+    """Releases every waiter together once `parties` have arrived.
+
+    If a waiter has been waiting `timeout` seconds, the barrier opens for
+    everyone who has arrived; later arrivals pass straight through.
+    """
+
+    def __init__(self, parties):
+        self._parties = parties
+        self._arrived = 0
+        self._open = asyncio.Event()
+
+    async def wait(self, timeout):
+        self._arrived += 1
+        if self._arrived >= self._parties:
+            self._open.set()
+        try:
+            await asyncio.wait_for(self._open.wait(), timeout)
+        except asyncio.TimeoutError:
+            self._open.set()
+
+
+class _LatencyHistogram:
+    """Log-bucketed latency histogram (~10% resolution); O(1) to record."""
+
+    _LOG_BASE = math.log(1.1)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._buckets = collections.Counter()
+
+    def record(self, ms):
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+        self._buckets[math.floor(math.log(max(ms, 0.01)) / self._LOG_BASE)] += 1
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= target:
+                return min(math.exp((bucket + 1) * self._LOG_BASE), self.max_ms)
+        return self.max_ms
+
+    def summary(self):
+        def _r(v):
+            return None if v is None else round(v, 1)
+        return {
+            "count":   self.count,
+            "mean_ms": _r(self.total_ms / self.count) if self.count else None,
+            "p50_ms":  _r(self.percentile(0.50)),
+            "p95_ms":  _r(self.percentile(0.95)),
+            "p99_ms":  _r(self.percentile(0.99)),
+            "max_ms":  _r(self.max_ms) if self.count else None,
+        }
+
+
+# Stage timings for the `stats` command.  _run_request binds a dict to this
+# variable and the code along the request's path adds seconds to it by stage:
+#   queue    admission queue, coalescer and device lane waits
+#   acquire  getting a connection in _with_retry (includes the three below)
+#   lock     waiting for the device's _conn_lock
+#   discover _build_config: manual config or mDNS/unicast scan
+#   connect  pyatv.connect
+#   device   the command's round trip to the device
+# While tracing, _TRACE holds the request's (tracer, tid, args) and every
+# stage is also written as a span.
+_STAGES = contextvars.ContextVar("ftv_stages", default=None)
+_TRACE = contextvars.ContextVar("ftv_trace", default=None)
+STATS_MAX_COMMANDS = 128   # distinct command names tracked; the rest pool as "other"
+
+
+def _trace_span(name, started, ended=None):
+    trace = _TRACE.get()
+    if trace is not None:
+        trace[0].span(name, started, ended, trace[1], trace[2])
+
+
+def _add_stage(stage, started):
+    """Charge the time since `started` to the current request's `stage`."""
+    now = time.monotonic()
+    stages = _STAGES.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + now - started
+    _trace_span(stage, started, now)
+
+
+def _bind_stages(fn, span=None):
+    """Wrap a job factory so the job records into the submitting request.
+
+    Lane and coalescer jobs run in the scheduler's task rather than the
+    request's, so the ContextVars have to be carried across by hand.  The
+    time until the job starts is charged to "queue"; with `span`, the job's
+    own run time is traced under that name.
+    """
+    stages = _STAGES.get()
+    if stages is None:
+        return fn
+    trace = _TRACE.get()
+    queued = time.monotonic()
+
+    async def _job():
+        _STAGES.set(stages)
+        _TRACE.set(trace)
+        _add_stage("queue", queued)
+        started = time.monotonic()
+        try:
+            return await fn()
+        finally:
+            if span is not None:
+                _trace_span(span, started)
+    return _job
+
+
+class _RequestStats:
+    """Per-command latency with a per-stage breakdown, and per-device counters.
+
+    Recording costs a few dict updates per request; percentiles are only
+    computed when `stats` is asked for.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.monotonic()
+        self.commands = collections.defaultdict(_LatencyHistogram)
+        self.stages = collections.defaultdict(_LatencyHistogram)   # (cmd, stage)
+        self.failed = collections.Counter()                        # cmd -> errors
+        self.devices = collections.defaultdict(collections.Counter)
+        self.device_errors = collections.defaultdict(collections.Counter)
+
+    def record(self, cmd, ms, stages, ok=True):
+        if cmd not in self.commands and len(self.commands) >= STATS_MAX_COMMANDS:
+            cmd = "other"
+        self.commands[cmd].record(ms)
+        for stage, seconds in stages.items():
+            self.stages[(cmd, stage)].record(seconds * 1000)
+        if not ok:
+            self.failed[cmd] += 1
+
+    def count(self, device_id, counter):
+        """Bump a per-device counter: "retries", "connects" or "reconnects"."""
+        self.devices[device_id][counter] += 1
+
+    def error(self, device_id, kind):
+        self.device_errors[device_id][kind] += 1
+
+    def device_ids(self):
+        return set(self.devices) | set(self.device_errors)
+
+    def forget(self, device_id):
+        self.devices.pop(device_id, None)
+        self.device_errors.pop(device_id, None)
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.since
+        total = sum(h.count for h in self.commands.values())
+        stages = collections.defaultdict(dict)
+        for (cmd, stage), hist in self.stages.items():
+            stages[cmd][stage] = hist.summary()
+        return {
+            "since_s": round(elapsed, 1),
+            "requests": total,
+            "requests_per_s": round(total / elapsed, 2) if elapsed > 0 else None,
+            "commands": {
+                cmd: {**hist.summary(), "errors": self.failed[cmd], "stages": stages[cmd]}
+                for cmd, hist in self.commands.items()
+            },
+            "devices": {
+                device_id: {
+                    "retries": self.devices[device_id]["retries"],
+                    "connects": self.devices[device_id]["connects"],
+                    "reconnects": self.devices[device_id]["reconnects"],
+                    "errors": dict(self.device_errors[device_id]),
+                }
+                for device_id in self.device_ids()
+            },
+        }
+
+
+class _SpanTracer:
+    """Appends request spans to a local file in Chrome's trace event format.
+
+    The file is a JSON array with one event per line and no closing bracket,
+    which chrome://tracing and Perfetto load as is and scripts/ftv_trace.py
+    reads line by line.  Each request gets its own `tid`, so its spans share
+    a row.  Past max_bytes the file is rotated to .1, .2, ...
+    """
+
+    def __init__(self, path=TRACE_PATH, max_bytes=TRACE_MAX_BYTES, backups=TRACE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.spans = 0
+        self._file = None
+        self._size = 0
+        self._seq = 0
+        self._pid = os.getpid()
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def start(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._open()
+
+    def stop(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self):
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+        if self._size == 0:
+            self._file.write("[\n")
+            self._size = 2
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+        self._open()
+
+    def request(self, id_, cmd, args):
+        """Return the trace context to bind to _TRACE for a new request."""
+        self._seq += 1
+        device = args[0] if cmd in DEVICE_COMMANDS and args else None
+        return (self, self._seq, {"id": id_, "cmd": cmd, "device": device})
+
+    def span(self, name, started, ended, tid, args):
+        if self._file is None:
+            return   # stopped while the request was running
+        if ended is None:
+            ended = time.monotonic()
+        line = json.dumps({
+            "name": name, "cat": "ftv", "ph": "X", "pid": self._pid, "tid": tid,
+            "ts": round(started * 1e6), "dur": round((ended - started) * 1e6),
+            "args": args,
+        }) + ",\n"
+        self._file.write(line)
+        self._size += len(line)
+        self.spans += 1
+        if self._size >= self.max_bytes:
+            self._rotate()
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+
+def _request_deadline(msg, inherited=None, received=None):
+    """Absolute monotonic deadline from the request's relative deadline_ms.
+
+    deadline_ms counts from `received` (when the request was read).  A
+    batch's deadline is inherited by its sub-requests; the earlier wins.
+    """
+    deadline_ms = msg.get("deadline_ms")
+    if deadline_ms is None:
+        return inherited
+    if received is None:
+        received = time.monotonic()
+    deadline = received + float(deadline_ms) / 1000
+    return deadline if inherited is None else min(deadline, inherited)
+
+
+def _request_priority(msg):
+    priority = msg.get("priority")
+    if priority in PRIORITIES:
+        return priority
+    if msg.get("cmd") in BACKGROUND_COMMANDS:
+        return PRIORITY_BACKGROUND
+    return PRIORITY_INTERACTIVE
+
+
+# ── Wire codecs ───────────────────────────────────────────────────────────────
+#
+# Newline-delimited JSON is the default.  A client may send
+#   {"id": "0", "cmd": "hello", "args": [["msgpack", "orjson", "json"]]}
+# as its first message; the daemon answers (still in the current codec) with
+# {"codec": <chosen>, "codecs": [<available>]} and both sides switch to the
+# first mutually supported codec for every later message.  msgpack and orjson
+# are optional dependencies and are only offered when importable.
+
+class _JsonCodec:
+    name = "json"
+
+    def encode(self, obj):
+        return json.dumps(obj).encode() + b"\n"
+
+    def decode(self, data):
+        return json.loads(data)
+
+    async def read(self, reader):
+        """Return the next message body, b"" for a blank line, None on EOF."""
+        line = await reader.readline()
+        if not line:
+            return None
+        return line.strip()
+
+
+class _OrjsonCodec(_JsonCodec):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def encode(self, obj):
+        return self._orjson.dumps(obj, default=str) + b"\n"
+
+    def decode(self, data):
+        return self._orjson.loads(data)
+
+
+class _MsgpackCodec:
+    """msgpack bodies, each prefixed with a 4-byte big-endian length."""
+
+    name = "msgpack"
+    _HEADER = struct.Struct(">I")
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def encode(self, obj):
+        body = self._msgpack.packb(obj, use_bin_type=True, default=str)
+        return self._HEADER.pack(len(body)) + body
+
+    def decode(self, data):
+        try:
+            return self._msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise ValueError(str(e)) from e
+
+    async def read(self, reader):
+        """Return the next frame body, None on EOF.
+
+        Raises ValueError for a length over MAX_FRAME_BYTES, after skipping
+        to the end of the line so a stray JSON request doesn't desync the
+        frames that follow.
+        """
+        try:
+            header = await reader.readexactly(self._HEADER.size)
+            (length,) = self._HEADER.unpack(header)
+            if length > MAX_FRAME_BYTES:
+                await reader.readline()
+                raise ValueError(f"frame of {length} bytes exceeds {MAX_FRAME_BYTES}"
+                                 " (was a request sent before the hello response?)")
+            return await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            return None
+
+
+def _available_codecs():
+    """Return {name: codec} for every codec usable in this environment."""
+    codecs = {"json": _JsonCodec()}
+    for cls in (_OrjsonCodec, _MsgpackCodec):
+        try:
+            codecs[cls.name] = cls()
+        except ImportError:
+            pass
+    return codecs
+
+
+class _OutputWriter:
+    """Buffered, non-blocking stdout for responses and events.
+
+    write() only appends to a buffer.  A writer task hands everything that
+    accumulated since its previous pass to the pipe in a single write and
+    awaits drain(), so a client that stops reading never blocks the event
+    loop.  Above high_water buffered bytes, droppable writes (events) are
+    discarded and wait_writable() holds request workers back.
+    """
+
+    def __init__(self, high_water=WRITE_HIGH_WATER):
+        self.high_water = high_water
+        self._buffer = []        # (bytes, enqueued at)
+        self._buffered = 0       # bytes queued or being written
+        self._wakeup = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._stream = None
+        self._task = None
+        self.writes = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.latency = _LatencyHistogram()   # enqueue -> handed to the OS
+
+    async def start(self, pipe):
+        """Attach to a pipe/tty; raises ValueError for e.g. a regular file."""
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, pipe
         )
-    return result
+        transport.set_write_buffer_limits(high=self.high_water)
+        self._stream = asyncio.StreamWriter(transport, protocol, None, loop)
+        self._task = loop.create_task(self._run())
+
+    def write(self, data, droppable=False):
+        if droppable and self._buffered >= self.high_water:
+            self.dropped += 1
+            return
+        self._buffer.append((data, time.monotonic()))
+        self._buffered += len(data)
+        self.writes += 1
+        if self._buffered >= self.high_water:
+            self._writable.clear()
+        self._wakeup.set()
+
+    async def wait_writable(self):
+        await self._writable.wait()
+
+    async def _flush_once(self):
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+        data = b"".join(chunk for chunk, _ in batch)
+        self._stream.write(data)
+        await self._stream.drain()
+        self._buffered -= len(data)
+        self.flushes += 1
+        done = time.monotonic()
+        for _chunk, enqueued in batch:
+            self.latency.record((done - enqueued) * 1000)
+        if self._buffered < self.high_water:
+            self._writable.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self._flush_once()
+
+    async def close(self, timeout=1.0):
+        """Flush what is buffered (bounded by timeout) and stop."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await asyncio.wait_for(self._flush_once(), timeout)
+        except (asyncio.TimeoutError, OSError):
+            pass
+        self._stream.close()
+        self._task = None
+
+    def stats(self):
+        return {
+            "buffered_bytes": self._buffered,
+            "high_water": self.high_water,
+            "writes": self.writes,
+            "flushes": self.flushes,
+            "dropped_events": self.dropped,
+            "latency": self.latency.summary(),
+        }
 
 
 # ── Daemon ────────────────────────────────────────────────────────────────────
 
 class FTVDaemon:
     def __init__(self):
+        self._config = ConfigStore()
+        self._discovery = DiscoveryCache()
         self._connections = {}   # device_id -> atv object
-        self._conn_locks = {}    # device_id -> asyncio.Lock (serialises reconnects)
-        self._details_cache = {} # device_id -> network-scanned device info dict
+        self._conn_used = {}     # device_id -> monotonic time of last use (pool LRU)
+        self._pool_evicted = set()   # closed by the pool; the next connect counts
+        self._pool_stats = collections.Counter()   # evictions by reason, reconnects
+        self._multi_targets = collections.Counter()  # device_id -> running `multi`s
+        # device_id -> asyncio.Lock (serialises reconnects); held locks stay
+        self._conn_locks = _BoundedCache(CONN_LOCKS_SIZE, keep=self._keep_conn_lock)
+        # device_id -> network-scanned device info dict
+        self._details_cache = _BoundedCache(DETAILS_CACHE_SIZE, DETAILS_CACHE_TTL)
+        # device_id -> (pyatv pairing handler, config) awaiting pair_pin
+        self._active_pairings = _BoundedCache(
+            PAIRING_SESSIONS, PAIRING_TTL, on_evict=lambda _id, session: session[0].close()
+        )
+        # device_id -> service ports seen at pair_begin, for pair_save
+        self._pair_ports_cache = _BoundedCache(PAIRING_SESSIONS, PAIRING_TTL)
+        # device_id -> (last good status_all entry, monotonic time)
+        self._status_cache = _BoundedCache(STATUS_CACHE_SIZE)
+        self._metadata_subs = {} # device_id -> _MetadataListener (push updates)
+        self._last_metadata = {} # device_id -> last metadata dict sent to client
+        self._device_listeners = {}  # device_id -> _DeviceListener
+        self._probe_targets = {}     # device_id -> (address, port) for keepalives
+        self._reconnect_tasks = {}   # device_id -> background reconnect task
+        self._prewarm_tasks = {}     # device_id -> background prewarm task
+        self._breakers = {}          # device_id -> _CircuitBreaker (configured devices)
+        self._errors = collections.Counter()  # ERROR_* kind -> device command failures
+        self._directory = None       # DeviceDirectory when FTV_MDNS_LISTENER is on
+        self._scan_seq = 0           # id for scan_result / scan_complete events
+        self._discovery_wins = collections.Counter()   # winning scan path -> count
+        self._discovery_latency = collections.defaultdict(_LatencyHistogram)
+        self._recent_devices = collections.OrderedDict()  # MRU order, newest last
+        self._health = collections.defaultdict(_health_counters)
+        self._codecs = _available_codecs()
+        self._codec = self._codecs["json"]
+        self._coalescer = _Coalescer()
+        self._lanes = _LaneScheduler()
+        self._latency = {p: _LatencyHistogram() for p in PRIORITIES}
+        self._stats = _RequestStats()
+        self._tracer = _SpanTracer()
+        self._profile = None          # (cProfile.Profile, started, auto-stop handle)
+        self._memory_snapshot = None  # last memory_report's tracemalloc snapshot
+        self._inflight = {}   # request id -> [work tasks] (targets for `cancel`)
+        self._out = None      # _OutputWriter once run() has attached stdout
+        self._admission = None        # asyncio.Queue of (received, msg)
+        self._admission_peak = 0
+        self._running = set()         # admitted _execute tasks
+        self._slots = None            # asyncio.Semaphore(MAX_IN_FLIGHT), made in run()
 
     # ── I/O helpers ───────────────────────────────────────────────────────────
 
-    def _respond(self, id_, *, result=None, error=None):
+    @staticmethod
+    def _response(id_, *, result=None, error=None):
         if error is not None:
-            msg = {"id": id_, "error": str(error)}
-        else:
-            msg = {"id": id_, "result": result if result is not None else {}}
-        print(json.dumps(msg), flush=True)
+            response = {"id": id_, "error": str(error)}
+            if isinstance(error, Exception):
+                response["kind"] = _classify_error(error)
+            return response
+        return {"id": id_, "result": result if result is not None else {}}
+
+    def _write(self, msg, droppable=False):
+        data = self._codec.encode(msg)
+        if self._out is not None:
+            self._out.write(data, droppable)
+            return
+        out = sys.stdout.buffer
+        out.write(data)
+        out.flush()
+
+    def _respond(self, id_, *, result=None, error=None):
+        self._write(self._response(id_, result=result, error=error))
+
+    def _emit(self, event, **fields):
+        """Write an unsolicited event message (no request id).
+
+        Events are dropped rather than queued while stdout is backed up.
+        """
+        self._write({"event": event, **fields}, droppable=True)
+
+    def _negotiate(self, msg):
+        """Handle `hello`: reply in the current codec, then switch codecs.
+
+        args[0] is the client's codec preference list (a flat list of names
+        is accepted too); anything else is answered with a user_input error
+        and the codec is left unchanged.
+        """
+        wanted = msg.get("args") or [["json"]]
+        if isinstance(wanted, list) and isinstance(wanted[0], list):
+            wanted = wanted[0]
+        if not isinstance(wanted, list) or not all(isinstance(n, str) for n in wanted):
+            self._respond(msg.get("id", "?"), error=ValueError(
+                "hello requires a list of codec names, e.g. [[\"msgpack\", \"json\"]]"))
+            return
+        chosen = next((name for name in wanted if name in self._codecs), "json")
+        self._respond(msg.get("id", "?"), result={
+            "codec": chosen,
+            "codecs": list(self._codecs),
+        })
+        self._codec = self._codecs[chosen]
 
     def _conn_lock(self, device_id):
-        if device_id not in self._conn_locks:
-            self._conn_locks[device_id] = asyncio.Lock()
-        return self._conn_locks[device_id]
+        return self._conn_locks.get_or_create(device_id, asyncio.Lock)
+
+    def _keep_conn_lock(self, device_id, lock):
+        """Never evict a lock someone may still acquire.
+
+        locked() is False between release() and the woken waiter running, so
+        waiters count too; evicting then would hand a second lock for the
+        same device to the next caller and allow two concurrent _connects.
+        """
+        return (lock.locked() or bool(getattr(lock, "_waiters", None))
+                or device_id in self._connections or self._lanes.busy(device_id))
 
     # ── Connection management ──────────────────────────────────────────────────
 
@@ -185,8 +1517,8 @@ class FTVDaemon:
         new_address = str(getattr(config, "address", "") or "")
         ports = _extract_service_ports(config)
 
-        cfg = load_config()
-        entry = find_device(cfg, device_id)
+        cfg = self._config.get()
+        entry = self._config.find(device_id)
         if entry is None:
             return
 
@@ -199,35 +1531,62 @@ class FTVDaemon:
                 entry["address"] = new_address
             if ports:
                 entry["services"] = ports
-            save_config(cfg)
+            self._config.save(cfg)
+
+    def _directory_entry(self, identifier, address=None):
+        """Live directory entry for identifier (or, failing that, address)."""
+        if self._directory is None:
+            return None
+        entry = self._directory.get(identifier)
+        if entry is None and address:
+            entry = self._directory.find_by_address(address)
+        return entry
+
+    async def _start_directory(self):
+        directory = DeviceDirectory(
+            _scan_protocols(SCAN_PROTOCOLS), on_change=self._on_directory_change
+        )
+        try:
+            await directory.start()
+        except (ImportError, OSError) as e:
+            print(f"[directory] mDNS listener unavailable: {e}", file=sys.stderr, flush=True)
+            await directory.stop()
+            return
+        self._directory = directory
+
+    def _on_directory_change(self, entry, old):
+        """A device was announced or moved: update devices.json to match."""
+        known = [
+            d["id"] for d in self._config.get().get("devices", [])
+            if d["id"] in entry["identifiers"]
+        ]
+        for device_id in known:
+            self._persist_device_address(device_id, to_config(entry))
+            moved = old is not None and old["address"] != entry["address"]
+            if moved and device_id in self._connections:
+                # The open connection points at the old address; reconnect.
+                print(f"[directory] {device_id} moved {old['address']} -> {entry['address']}",
+                      file=sys.stderr, flush=True)
+                self._on_connection_lost(device_id, self._connections[device_id], None)
 
     async def _build_config(self, entry):
         """Resolve device address/services and apply stored credentials.
 
         For cross-VLAN devices (no mDNS), goes directly to manual config.
         Falls back to mDNS scan only when manual config isn't possible.
+        Returns (config, source): source is "manual" or the _discover path.
         """
-        import pyatv
         from pyatv.const import Protocol
 
-        loop = asyncio.get_running_loop()
-
-        # Try manual config first — works cross-VLAN without mDNS.
-        config = _build_manual_config(entry)
+        # Try manual config first — works cross-VLAN without mDNS, and needs
+        # no network round trip, so there is nothing to race it against.
+        config, source = _build_manual_config(entry), "manual"
 
         if config is None:
             # No stored ports/creds — attempt mDNS discovery.
-            match = None
-            if entry.get("address"):
-                atvs = await pyatv.scan(loop, hosts=[entry["address"]], timeout=5)
-                match = next((a for a in atvs if a.identifier == entry["id"]), None)
-            if match is None:
-                atvs = await pyatv.scan(loop, identifier=entry["id"], timeout=5)
-                if atvs:
-                    match = atvs[0]
-            if match is None:
-                return None
-            config = match
+            config, source = await self._discover(entry["id"], entry.get("address"))
+            if config is None:
+                return None, source
             # Persist fresh address + service ports for future cross-VLAN use.
             self._persist_device_address(entry["id"], config)
 
@@ -237,53 +1596,764 @@ class FTVDaemon:
             config.set_credentials(Protocol.Companion, entry["credentials_companion"])
         if "credentials_airplay" in entry:
             config.set_credentials(Protocol.AirPlay, entry["credentials_airplay"])
-        return config
+        return config, source
+
+    async def _discover(self, identifier, address=None, any_at_host=False):
+        """Locate a device: mDNS directory, then a fresh discovery-cache entry,
+        else race scans.
+
+        Records which path won ("directory", "cache", "host", "identifier" or
+        "not_found") and how long it took; returns (config, path).
+        """
+        started = time.monotonic()
+        entry, path = self._directory_entry(identifier, address if any_at_host else None), "directory"
+        if entry is None:
+            entry, path = self._discovery.get(identifier), "cache"
+            if entry is None and any_at_host and address:
+                entry = self._discovery.find_by_address(address)
+        if entry is not None:
+            config = to_config(entry)
+        else:
+            config, path = await _race_discovery(identifier, address, any_at_host)
+            if config is not None:
+                self._discovery.record([config])
+        elapsed = (time.monotonic() - started) * 1000
+        path = path or "not_found"
+        self._discovery_wins[path] += 1
+        self._discovery_latency[path].record(elapsed)
+        print(f"[discovery] {identifier}: {path} in {elapsed:.0f} ms", file=sys.stderr, flush=True)
+        return config, path
+
+    async def _stream_scan(self, protocols, timeout):
+        """Scan the network, emitting a scan_result event per Apple TV found.
+
+        An MdnsBrowser runs for the protocols' service types and each settled
+        burst of new services triggers a scan pass, so results arrive within a
+        few hundred ms instead of after the full timeout.  A device is
+        re-emitted if a later pass changes its entry; clients should key
+        results by address.  Without zeroconf this degrades to a single
+        pyatv.scan.
+        """
+        import pyatv
+
+        loop = asyncio.get_running_loop()
+        self._scan_seq += 1
+        scan_id = self._scan_seq
+        started = time.monotonic()
+        known_ids = {d["id"] for d in self._config.get().get("devices", [])}
+        found = {}  # address -> device dict last emitted
+
+        def _publish(configs):
+            self._discovery.record(configs)
+            for config in configs:
+                if not _is_apple_tv(config):
+                    continue
+                device = _scan_entry(config, known_ids)
+                if found.get(device["address"]) != device:
+                    found[device["address"]] = device
+                    self._emit("scan_result", scan_id=scan_id, device=device,
+                               elapsed_ms=round((time.monotonic() - started) * 1000))
+
+        browser = MdnsBrowser(protocols)
+        try:
+            await browser.start()
+        except (ImportError, OSError) as e:
+            await browser.stop()
+            print(f"[scan] zeroconf unavailable ({e}); using a plain scan",
+                  file=sys.stderr, flush=True)
+            _publish(await pyatv.scan(loop, timeout=math.ceil(timeout), protocol=protocols))
+        else:
+            deadline = started + timeout
+            try:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not await browser.wait(remaining):
+                        break
+                    _publish(await browser.scan())
+                if browser.pending:
+                    _publish(await browser.scan())
+            finally:
+                await browser.stop()
+
+        devices = list(found.values())
+        elapsed = round((time.monotonic() - started) * 1000)
+        self._emit("scan_complete", scan_id=scan_id, devices=devices, elapsed_ms=elapsed)
+        print(f"[scan] {scan_id}: {len(devices)} device(s) in {elapsed} ms",
+              file=sys.stderr, flush=True)
+        return {"scan_id": scan_id, "devices": devices}
 
     async def _connect(self, device_id):
         """Open a fresh connection; store it in self._connections."""
         import pyatv
 
-        cfg = load_config()
-        entry = find_device(cfg, device_id)
+        entry = self._config.find(device_id)
         if entry is None:
             raise ValueError(f"Device '{device_id}' not found in config")
 
-        config = await self._build_config(entry)
+        started = time.monotonic()
+        config, source = await self._build_config(entry)
+        _add_stage("discover", started)
         if config is None:
             raise ConnectionError(f"Device '{device_id}' not found on network")
 
         # Cache device_info while we already have the scan result; avoids a
         # re-scan when the user subsequently opens the device details dialog.
-        self._details_cache[device_id] = _extract_device_info(config)
+        self._details_cache[device_id] = extract_device_info(config)
 
-        atv = await pyatv.connect(config, asyncio.get_running_loop())
+        started = time.monotonic()
+        try:
+            atv = await pyatv.connect(config, asyncio.get_running_loop())
+        except Exception as e:
+            # A stale discovery-cache entry must not be reused on the retry;
+            # other sources, and credential errors, say nothing about it.
+            if source == "cache" and _classify_error(e) == ERROR_TRANSPORT:
+                self._discovery.forget(device_id)
+            raise
+        finally:
+            _add_stage("connect", started)
+        self._stats.count(device_id, "connects")
         self._connections[device_id] = atv
+        if device_id in self._pool_evicted:
+            self._pool_evicted.discard(device_id)
+            self._pool_stats["reconnects_after_eviction"] += 1
+        listener = _DeviceListener(self, device_id, atv)
+        self._device_listeners[device_id] = listener
+        atv.listener = listener
+        target = _probe_target(config)
+        if target is not None:
+            self._probe_targets[device_id] = target
+        if device_id in self._metadata_subs:
+            self._attach_push_updater(device_id, atv)
         return atv
 
-    async def _get_connection(self, device_id, reconnect=False):
-        """Return a cached or newly created connection; serialised per device."""
+    async def _get_connection(self, device_id, reconnect=False, probe=False):
+        """Return a cached or newly created connection; serialised per device.
+
+        New connections go through the device's circuit breaker; probe=True
+        (the background reconnect loop) bypasses the open-breaker check.
+        """
+        started = time.monotonic()
         async with self._conn_lock(device_id):
+            _add_stage("lock", started)
+            self._conn_used[device_id] = time.monotonic()
             if not reconnect and device_id in self._connections:
                 return self._connections[device_id]
+            if self._config.find(device_id) is None:
+                raise ValueError(f"Device '{device_id}' not found in config")
+            breaker = self._breaker(device_id)
+            if not probe and not breaker.allow():
+                raise DeviceUnreachable(device_id, breaker.retry_in())
             await self._close_connection(device_id)
-            return await self._connect(device_id)
+            try:
+                atv = await self._connect(device_id)
+            except ValueError:
+                raise   # not configured; says nothing about reachability
+            except Exception as e:
+                if breaker.failure():
+                    print(f"[health] {device_id}: unreachable after {breaker.failures} "
+                          f"failed connects ({e})", file=sys.stderr, flush=True)
+                    self._set_status(device_id, "unreachable", e,
+                                     retry_in_ms=round(breaker.retry_in() * 1000))
+                    self._schedule_reconnect(device_id)
+                raise
+            except BaseException:
+                # Cancelled (deadline_ms, `cancel`): the trial proved nothing,
+                # and a breaker left half_open would refuse every command.
+                breaker.abandon()
+                raise
+            if breaker.success():
+                print(f"[health] {device_id}: reachable again", file=sys.stderr, flush=True)
+                if not probe:
+                    # The reconnect loop reports its own success.
+                    self._set_status(device_id, "ready")
+        await self._enforce_pool_limit(device_id)
+        return atv
+
+    def _pinned(self, device_id):
+        return (device_id == self._config.get().get("selected")
+                or device_id in self._metadata_subs
+                or device_id in self._multi_targets
+                or self._lanes.busy(device_id))
+
+    async def _evict_connection(self, device_id, reason):
+        print(f"[pool] {device_id}: closing ({reason})", file=sys.stderr, flush=True)
+        await self._close_connection(device_id)
+        self._pool_evicted.add(device_id)
+        self._pool_stats[f"evictions_{reason}"] += 1
+        self._set_status(device_id, "idle")
+
+    async def _enforce_pool_limit(self, opened=None):
+        """Close least recently used, unpinned connections beyond MAX_CONNECTIONS.
+
+        `opened` (the connection just made) is never chosen.  With everything
+        else pinned the pool stays over its cap until something unpins.
+        """
+        over = len(self._connections) - MAX_CONNECTIONS
+        if over <= 0:
+            return
+        by_age = sorted(self._connections, key=lambda d: self._conn_used.get(d, 0))
+        for device_id in by_age:
+            if over <= 0:
+                break
+            if device_id != opened and not self._pinned(device_id):
+                await self._evict_connection(device_id, "lru")
+                over -= 1
+
+    async def _close_idle_connections(self):
+        if CONNECTION_IDLE_TIMEOUT <= 0:
+            return
+        cutoff = time.monotonic() - CONNECTION_IDLE_TIMEOUT
+        for device_id in list(self._connections):
+            if self._conn_used.get(device_id, 0) < cutoff and not self._pinned(device_id):
+                await self._evict_connection(device_id, "idle")
+
+    def _pool_snapshot(self):
+        return {
+            "open": len(self._connections),
+            "max": MAX_CONNECTIONS,
+            "idle_timeout_s": CONNECTION_IDLE_TIMEOUT,
+            "pinned": sorted(d for d in self._connections if self._pinned(d)),
+            "evictions_lru": self._pool_stats["evictions_lru"],
+            "evictions_idle": self._pool_stats["evictions_idle"],
+            "reconnects_after_eviction": self._pool_stats["reconnects_after_eviction"],
+        }
 
     async def _close_connection(self, device_id):
+        # Popped before close() so the listener's connection_closed callback
+        # sees an intentional close and doesn't schedule a reconnect.
+        self._conn_used.pop(device_id, None)
         atv = self._connections.pop(device_id, None)
+        self._device_listeners.pop(device_id, None)
+        self._probe_targets.pop(device_id, None)
         if atv:
             try:
                 atv.close()
             except Exception:
                 pass
 
-    async def _with_retry(self, device_id, fn):
-        """Run fn(atv); on any exception reconnect once and retry."""
+    # ── Connection health ──────────────────────────────────────────────────────
+
+    def _set_status(self, device_id, status, error=None, **extra):
+        """Tell clients whether a device's connection is usable.
+
+        status: "connecting" | "ready" | "failed" | "disconnected" | "unreachable"
+                | "idle" (closed by the connection pool; reopens on next use)
+        """
+        fields = {"device_id": device_id, "status": status, **extra}
+        if error is not None:
+            fields["error"] = str(error)
+        self._emit("connection_status", **fields)
+
+    def _on_connection_lost(self, device_id, atv, exception):
+        if self._connections.get(device_id) is not atv:
+            return   # stale connection or an intentional close
+        print(f"[health] {device_id}: connection lost ({exception})", file=sys.stderr, flush=True)
+        self._health[device_id]["lost"] += 1
+        self._set_status(device_id, "disconnected", exception)
+        self._connections.pop(device_id, None)
+        self._device_listeners.pop(device_id, None)
         try:
-            atv = await self._get_connection(device_id)
-            return await fn(atv)
+            atv.close()
         except Exception:
-            atv = await self._get_connection(device_id, reconnect=True)
-            return await fn(atv)
+            pass
+        self._schedule_reconnect(device_id)
+
+    def _schedule_reconnect(self, device_id):
+        task = self._reconnect_tasks.get(device_id)
+        if task is None or task.done():
+            self._reconnect_tasks[device_id] = asyncio.get_running_loop().create_task(
+                self._reconnect_loop(device_id)
+            )
+
+    async def _reconnect_loop(self, device_id):
+        """Reconnect in the background so the next press finds a live link."""
+        _STAGES.set(None)   # not part of the request that scheduled it
+        _TRACE.set(None)
+        stats = self._health[device_id]
+        breaker = self._breaker(device_id)
+        try:
+            attempt = 0
+            while attempt < RECONNECT_MAX_ATTEMPTS or breaker.state != breaker.CLOSED:
+                if breaker.state == breaker.CLOSED:
+                    delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt)
+                else:
+                    # An open breaker keeps probing on its own (doubling) cooldown.
+                    delay = max(breaker.retry_in(), RECONNECT_BASE_DELAY)
+                attempt += 1
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                if self._config.find(device_id) is None:
+                    return
+                started = time.monotonic()
+                try:
+                    await self._get_connection(device_id, probe=True)
+                except Exception as e:
+                    stats["reconnect_failures"] += 1
+                    print(f"[health] {device_id}: reconnect attempt {attempt} failed: {e}",
+                          file=sys.stderr, flush=True)
+                    continue
+                elapsed = (time.monotonic() - started) * 1000
+                stats["reconnects"] += 1
+                self._stats.count(device_id, "reconnects")
+                stats["last_reconnect_ms"] = round(elapsed, 1)
+                stats["total_reconnect_ms"] += elapsed
+                self._set_status(device_id, "ready")
+                return
+            # Give up; the next command will reconnect on demand.
+            if device_id in self._metadata_subs:
+                self._emit("metadata", device_id=device_id, error="device unreachable")
+        finally:
+            if self._reconnect_tasks.get(device_id) is asyncio.current_task():
+                del self._reconnect_tasks[device_id]
+
+    # ── Prewarming ─────────────────────────────────────────────────────────────
+
+    def _prewarm_selected(self):
+        """Warm the selected device plus up to PREWARM_EXTRA recent others."""
+        if not PREWARM:
+            return
+        selected = self._config.get().get("selected")
+        targets = [selected] if selected else []
+        if PREWARM_EXTRA > 0:
+            recent = [d for d in reversed(self._recent_devices)
+                      if d != selected and self._config.find(d) is not None]
+            targets += recent[:PREWARM_EXTRA]
+        for device_id in targets:
+            self._prewarm(device_id)
+
+    def _prewarm(self, device_id):
+        if device_id in self._connections:
+            self._set_status(device_id, "ready")
+            return
+        task = self._prewarm_tasks.get(device_id)
+        if task is None or task.done():
+            self._prewarm_tasks[device_id] = asyncio.get_running_loop().create_task(
+                self._prewarm_connection(device_id)
+            )
+
+    async def _prewarm_connection(self, device_id):
+        _STAGES.set(None)   # not part of the select_device request
+        _TRACE.set(None)
+        self._set_status(device_id, "connecting")
+        try:
+            await self._get_connection(device_id)
+        except DeviceUnreachable as e:
+            breaker = self._breaker(device_id)
+            self._set_status(device_id, "unreachable", e,
+                             retry_in_ms=round(breaker.retry_in() * 1000))
+        except Exception as e:
+            self._set_status(device_id, "failed", e)
+        else:
+            self._set_status(device_id, "ready")
+        finally:
+            self._prewarm_tasks.pop(device_id, None)
+
+    def _breaker(self, device_id):
+        breaker = self._breakers.get(device_id)
+        if breaker is None:
+            breaker = self._breakers[device_id] = _CircuitBreaker()
+        return breaker
+
+    def _forget_device(self, device_id):
+        """Drop the per-device bookkeeping kept outside the _BoundedCaches."""
+        self._breakers.pop(device_id, None)
+        self._health.pop(device_id, None)
+        self._conn_used.pop(device_id, None)
+        self._recent_devices.pop(device_id, None)
+        self._pool_evicted.discard(device_id)
+        self._stats.forget(device_id)
+
+    def _prune_device_state(self):
+        """Forget ids that are neither configured nor connected.
+
+        Catches devices removed by another process (ftv_setup.py) and ids a
+        client sent that never existed.
+        """
+        known = {d["id"] for d in self._config.get().get("devices", [])}
+        known |= set(self._connections) | set(self._reconnect_tasks)
+        tracked = (set(self._breakers) | set(self._health) | set(self._conn_used)
+                   | set(self._recent_devices) | self._pool_evicted | self._stats.device_ids())
+        for device_id in tracked - known:
+            self._forget_device(device_id)
+
+    def _caches(self):
+        return {
+            "details": self._details_cache,
+            "conn_locks": self._conn_locks,
+            "pairings": self._active_pairings,
+            "pair_ports": self._pair_ports_cache,
+            "status": self._status_cache,
+        }
+
+    async def _probe(self, device_id, atv, target):
+        """Check a cached connection; drop it on a transport failure.
+
+        Companion sessions must answer a round trip on the session itself
+        (FetchUserAccounts, the smallest request pyatv exposes), so a session
+        that died while the TV's port still accepts connections (Wi-Fi roam,
+        TV asleep) is dropped here rather than swallowing the next press.
+        Without Companion this falls back to a TCP connect to the control
+        port; pyatv's MRP protocol sends its own heartbeats and reports a dead
+        session through _DeviceListener.
+        """
+        from pyatv.const import FeatureName, FeatureState
+        try:
+            if atv.features.in_state(FeatureState.Available, FeatureName.AccountList):
+                await asyncio.wait_for(atv.user_accounts.account_list(), KEEPALIVE_TIMEOUT)
+            elif target is not None:
+                _reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(*target), KEEPALIVE_TIMEOUT
+                )
+                writer.close()
+        except Exception as e:
+            # A protocol error still means the session answered.
+            if _classify_error(e) == ERROR_TRANSPORT:
+                self._on_connection_lost(device_id, atv, e)
+
+    async def _keepalive_loop(self):
+        """Probe every cached connection at once; drop dead ones.
+
+        Also expires stale cache entries (closing abandoned pairing sessions).
+        """
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            for cache in self._caches().values():
+                cache.prune()
+            self._prune_device_state()
+            await self._close_idle_connections()
+            probes = [
+                self._probe(device_id, atv, self._probe_targets.get(device_id))
+                for device_id, atv in list(self._connections.items())
+            ]
+            # Concurrent, so a pass takes at most KEEPALIVE_TIMEOUT however
+            # many devices are connected.
+            await asyncio.gather(*probes)
+
+    async def _with_retry(self, device_id, fn, cmd=None):
+        """Run fn(atv) under cmd's retry policy (RETRY_POLICIES).
+
+        Only transport errors are retried, and every attempt shares the
+        command's deadline.  A connection that fails mid-command is dropped
+        through _on_connection_lost (which reconnects in the background);
+        the command is then re-sent only if it is idempotent.  Protocol,
+        unsupported and user-input errors leave the connection alone.
+        """
+        attempts, budget = RETRY_POLICIES.get(cmd, DEFAULT_RETRY_POLICY)
+        deadline = time.monotonic() + budget
+        attempt = 0
+        while True:
+            attempt += 1
+            if attempt > 1:
+                self._stats.count(device_id, "retries")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise CommandFailed(f"{cmd or 'command'} timed out after {budget:.0f}s",
+                                    ERROR_TRANSPORT)
+            started = time.monotonic()
+            try:
+                atv = await asyncio.wait_for(self._get_connection(device_id), remaining)
+            except DeviceUnreachable:
+                raise
+            except Exception as e:
+                kind = _classify_error(e)
+                self._errors[kind] += 1
+                self._stats.error(device_id, kind)
+                if kind != ERROR_TRANSPORT or attempt >= attempts:
+                    raise
+                continue
+            finally:
+                _add_stage("acquire", started)
+            started = time.monotonic()
+            try:
+                return await asyncio.wait_for(fn(atv), max(0.0, deadline - time.monotonic()))
+            except Exception as e:
+                kind = _classify_error(e)
+                self._errors[kind] += 1
+                self._stats.error(device_id, kind)
+                if kind != ERROR_TRANSPORT:
+                    raise
+                self._on_connection_lost(device_id, atv, e)
+                if cmd not in IDEMPOTENT_COMMANDS or attempt >= attempts:
+                    raise
+            finally:
+                _add_stage("device", started)
+
+    # ── Now-playing push updates ───────────────────────────────────────────────
+
+    def _attach_push_updater(self, device_id, atv):
+        """Point the connection's push updater at this device's listener."""
+        listener = self._metadata_subs.get(device_id)
+        if listener is None:
+            listener = _MetadataListener(self, device_id)
+            self._metadata_subs[device_id] = listener
+        atv.push_updater.listener = listener
+        if not atv.push_updater.active:
+            atv.push_updater.start()
+
+    def _on_playstatus(self, device_id, metadata):
+        if device_id not in self._metadata_subs:
+            return
+        if self._last_metadata.get(device_id) == metadata:
+            return
+        self._last_metadata[device_id] = metadata
+        self._emit("metadata", device_id=device_id, metadata=metadata)
+
+    def _on_playstatus_error(self, device_id, exception):
+        """The push updater stops on error; reconnect (which re-subscribes)."""
+        print(f"[push] {device_id}: {exception}", file=sys.stderr, flush=True)
+        atv = self._connections.get(device_id)
+        if device_id in self._metadata_subs and atv is not None:
+            self._on_connection_lost(device_id, atv, exception)
+
+    # ── Diagnostics ────────────────────────────────────────────────────────────
+
+    def _profile_start(self):
+        import cProfile
+
+        if self._profile is not None:
+            raise ValueError("a profile is already running; send profile_stop first")
+        profiler = cProfile.Profile()
+        profiler.enable()   # everything runs on the loop thread, so this sees it all
+        handle = asyncio.get_running_loop().call_later(
+            PROFILE_MAX_SECONDS, self._profile_stop, PROFILE_PATH
+        )
+        self._profile = (profiler, time.monotonic(), handle)
+        print("[profile] started", file=sys.stderr, flush=True)
+        return {"running": True, "max_seconds": PROFILE_MAX_SECONDS}
+
+    def _profile_stop(self, path):
+        """Stop the profile, dump pstats to `path`, return the top functions."""
+        import pstats
+
+        if self._profile is None:
+            raise ValueError("no profile is running")
+        profiler, started, handle = self._profile
+        self._profile = None
+        profiler.disable()
+        handle.cancel()
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        profiler.dump_stats(path)
+        stats = pstats.Stats(profiler).sort_stats(pstats.SortKey.TIME)
+        top = []
+        for func in stats.fcn_list[:PROFILE_TOP]:
+            _cc, calls, tottime, cumtime, _callers = stats.stats[func]
+            top.append({
+                "function": pstats.func_std_string(func),
+                "calls": calls,
+                "tottime_ms": round(tottime * 1000, 1),
+                "cumtime_ms": round(cumtime * 1000, 1),
+            })
+        elapsed = time.monotonic() - started
+        print(f"[profile] {elapsed:.0f} s written to {path}", file=sys.stderr, flush=True)
+        return {"path": path, "seconds": round(elapsed, 1), "top": top}
+
+    def _cache_sizes(self):
+        return {
+            "connections": len(self._connections),
+            "details_cache": len(self._details_cache),
+            "active_pairings": len(self._active_pairings),
+            "pair_ports_cache": len(self._pair_ports_cache),
+            "metadata_subs": len(self._metadata_subs),
+            "last_metadata": len(self._last_metadata),
+            "device_listeners": len(self._device_listeners),
+            "probe_targets": len(self._probe_targets),
+            "conn_locks": len(self._conn_locks),
+            "breakers": len(self._breakers),
+            "recent_devices": len(self._recent_devices),
+            "reconnect_tasks": len(self._reconnect_tasks),
+            "prewarm_tasks": len(self._prewarm_tasks),
+            "in_flight": len(self._inflight),
+            "discovery_cache": len(self._discovery),
+            "directory": 0 if self._directory is None else len(self._directory.devices()),
+        }
+
+    def _memory_report(self, limit):
+        """Top allocation sites (and growth since the last report) + cache sizes."""
+        import resource
+        import tracemalloc
+
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+
+        def _site(stat):
+            frame = stat.traceback[0]
+            return {
+                "site": f"{frame.filename}:{frame.lineno}",
+                "size_kb": round(stat.size / 1024, 1),
+                "count": stat.count,
+                **({"size_diff_kb": round(stat.size_diff / 1024, 1),
+                    "count_diff": stat.count_diff} if hasattr(stat, "size_diff") else {}),
+            }
+
+        previous, self._memory_snapshot = self._memory_snapshot, snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "tracing_started": started,   # earlier allocations are not attributed
+            "traced_kb": round(current / 1024, 1),
+            "traced_peak_kb": round(peak / 1024, 1),
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "top": [_site(s) for s in snapshot.statistics("lineno")[:limit]],
+            "growth": None if previous is None else [
+                _site(s) for s in snapshot.compare_to(previous, "lineno")[:limit]
+                if s.size_diff > 0
+            ],
+            "caches": self._cache_sizes(),
+        }
+
+    # ── Fan-out ────────────────────────────────────────────────────────────────
+
+    def _resolve_targets(self, targets):
+        """Device ids from a list of ids or the name of a devices.json group."""
+        if isinstance(targets, str):
+            groups = self._config.get().get("groups", {})
+            if targets not in groups:
+                raise ValueError(f"Unknown device group '{targets}'")
+            targets = groups[targets]
+        if not isinstance(targets, list) or not targets:
+            raise ValueError("multi requires a device list or group name")
+        return list(dict.fromkeys(str(t) for t in targets))
+
+    async def _multi(self, targets, cmd, cmd_args):
+        """Run one device command on many devices with aligned start times.
+
+        Returns per-device results with `latency_ms` and `offset_ms` (start
+        relative to the first device), plus `skew_ms` between the first and
+        last start.  Devices that could not be connected report their error
+        and are left out of the firing.
+        """
+        if cmd not in DEVICE_COMMANDS:
+            raise ValueError(f"multi cannot run '{cmd}'")
+        devices = self._resolve_targets(targets)
+        results = {}
+        started = time.monotonic()
+        # Pinned so connecting one target can't make the pool evict another.
+        self._multi_targets.update(devices)
+        try:
+            prepared = await asyncio.gather(*(
+                asyncio.wait_for(self._get_connection(d), MULTI_PREPARE_TIMEOUT)
+                for d in devices
+            ), return_exceptions=True)
+            ready = []
+            for device_id, outcome in zip(devices, prepared):
+                if isinstance(outcome, Exception):
+                    results[device_id] = {"error": str(outcome) or type(outcome).__name__,
+                                          "kind": _classify_error(outcome)}
+                else:
+                    ready.append(device_id)
+            prepare_ms = (time.monotonic() - started) * 1000
+
+            barrier = _Barrier(len(ready))
+            fired, finished = {}, {}
+
+            async def _fire(device_id):
+                await barrier.wait(MULTI_BARRIER_TIMEOUT)
+                fired[device_id] = time.monotonic()
+                try:
+                    return await self._dispatch(cmd, [device_id, *cmd_args])
+                finally:
+                    finished[device_id] = time.monotonic()
+
+            # Each device's job still queues in its lane behind earlier presses.
+            outcomes = await asyncio.gather(*(
+                self._lanes.submit(d, _bind_stages(lambda d=d: _fire(d), "dispatch"))
+                for d in ready
+            ), return_exceptions=True)
+        finally:
+            for device_id in devices:
+                self._multi_targets[device_id] -= 1
+                if not self._multi_targets[device_id]:
+                    del self._multi_targets[device_id]
+        await self._enforce_pool_limit()
+
+        first = min(fired.values(), default=None)
+        for device_id, outcome in zip(ready, outcomes):
+            entry = ({"error": str(outcome) or type(outcome).__name__,
+                      "kind": _classify_error(outcome)}
+                     if isinstance(outcome, BaseException) else {"result": outcome})
+            if device_id in fired:
+                entry["offset_ms"] = round((fired[device_id] - first) * 1000, 3)
+                entry["latency_ms"] = round((finished[device_id] - fired[device_id]) * 1000, 1)
+            results[device_id] = entry
+        return {
+            "results": results,
+            "prepare_ms": round(prepare_ms, 1),
+            "skew_ms": round((max(fired.values()) - first) * 1000, 3) if fired else None,
+            "completion_skew_ms": (
+                round((max(finished.values()) - min(finished.values())) * 1000, 1)
+                if finished else None
+            ),
+        }
+
+    # ── Aggregated status ──────────────────────────────────────────────────────
+
+    async def _device_status(self, device_id):
+        """Power, volume and now-playing over one connection, in one lane job."""
+        from pyatv.const import PowerState
+
+        async def _fn(atv):
+            status = {"on": atv.power.power_state == PowerState.On,
+                      "volume": None, "metadata": None}
+            try:
+                status["volume"] = atv.audio.volume
+            except Exception as e:
+                if _classify_error(e) != ERROR_UNSUPPORTED:
+                    raise
+            if device_id in self._last_metadata:
+                status["metadata"] = self._last_metadata[device_id]   # pushed
+            else:
+                try:
+                    status["metadata"] = _format_playing(await atv.metadata.playing())
+                except Exception as e:
+                    if _classify_error(e) != ERROR_UNSUPPORTED:
+                        raise
+            return status
+
+        return await self._lanes.submit(
+            device_id,
+            _bind_stages(lambda: self._with_retry(device_id, _fn, "status_all"), "dispatch"),
+            PRIORITY_BACKGROUND, ("status_all", device_id),
+        )
+
+    async def _status_all(self, timeout):
+        """Status of every configured device; stale cached values on failure."""
+        devices = self._config.get().get("devices", [])
+        slots = asyncio.Semaphore(STATUS_CONCURRENCY)
+        started = time.monotonic()
+
+        async def _one(entry):
+            device_id = entry["id"]
+            result = {"name": entry.get("name")}
+            async with slots:
+                try:
+                    status = await asyncio.wait_for(self._device_status(device_id), timeout)
+                except Exception as e:
+                    if isinstance(e, asyncio.TimeoutError):
+                        result.update(error=f"timed out after {timeout:g}s", kind=ERROR_TRANSPORT)
+                    else:
+                        result.update(error=str(e) or type(e).__name__, kind=_classify_error(e))
+                else:
+                    self._status_cache[device_id] = (status, time.monotonic())
+                    result.update(status=status, stale=False, age_s=0.0)
+                    return device_id, result
+            cached = self._status_cache.get(device_id)
+            if cached is not None:
+                status, stored = cached
+                result.update(status=status, stale=True,
+                              age_s=round(time.monotonic() - stored, 1))
+            else:
+                result.update(status=None, stale=True, age_s=None)
+            return device_id, result
+
+        results = await asyncio.gather(*(_one(entry) for entry in devices))
+        return {
+            "devices": dict(results),
+            "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+        }
 
     # ── Command dispatch ───────────────────────────────────────────────────────
 
@@ -293,20 +2363,111 @@ class FTVDaemon:
         # ── Commands that don't need a live device connection ─────────────────
 
         if cmd == "list_devices":
-            cfg = load_config()
+            cfg = self._config.get()
             return {
                 "devices": [
                     {"name": d["name"], "id": d["id"], "address": d.get("address", "")}
                     for d in cfg.get("devices", [])
                 ],
                 "selected": cfg.get("selected"),
+                "groups": cfg.get("groups", {}),
+            }
+
+        if cmd == "connection_health":
+            return {
+                "devices": {
+                    device_id: {
+                        "connected": device_id in self._connections,
+                        "reconnecting": device_id in self._reconnect_tasks,
+                        "breaker": breaker.snapshot() if breaker else None,
+                        **stats,
+                        "total_reconnect_ms": round(stats["total_reconnect_ms"], 1),
+                    }
+                    for device_id in set(self._health) | set(self._connections) | set(self._breakers)
+                    for stats in (self._health.get(device_id) or _health_counters(),)
+                    for breaker in (self._breakers.get(device_id),)
+                },
+                "discovery": {
+                    path: {"wins": count, **self._discovery_latency[path].summary()}
+                    for path, count in self._discovery_wins.items()
+                },
+                "errors": dict(self._errors),
+                "pool": self._pool_snapshot(),
+                "directory": None if self._directory is None else {
+                    "running": self._directory.running,
+                    "devices": len(self._directory.devices()),
+                    "refreshes": self._directory.refreshes,
+                    "evictions": self._directory.evictions,
+                },
             }
 
+        if cmd == "cancel":
+            if not args:
+                raise ValueError("cancel requires a request id")
+            tasks = self._inflight.get(str(args[0]), [])
+            for task in tasks:
+                task.cancel()
+            return {"cancelled": len(tasks)}
+
+        if cmd == "queue_status":
+            return {
+                "lanes": self._lanes.depths(),
+                "in_flight": sum(len(tasks) for tasks in self._inflight.values()),
+                "admission": {
+                    "queued": self._admission.qsize() if self._admission else 0,
+                    "peak_queued": self._admission_peak,
+                    "limit": ADMISSION_QUEUE_LIMIT,
+                    "running": len(self._running),
+                    "max_in_flight": MAX_IN_FLIGHT,
+                },
+                "writer": self._out.stats() if self._out else None,
+                "latency": {p: h.summary() for p, h in self._latency.items()},
+            }
+
+        if cmd == "trace":
+            if args and args[0] not in ("on", "off"):
+                raise ValueError("trace takes 'on' or 'off'")
+            if args and args[0] == "on":
+                self._tracer.start()
+            elif args:
+                self._tracer.stop()
+            return {"enabled": self._tracer.enabled, "path": self._tracer.path,
+                    "spans": self._tracer.spans}
+
+        if cmd == "profile_start":
+            return self._profile_start()
+
+        if cmd == "profile_stop":
+            return self._profile_stop(args[0] if args else PROFILE_PATH)
+
+        if cmd == "memory_report":
+            if args and args[0] == "stop":
+                import tracemalloc
+                tracemalloc.stop()
+                self._memory_snapshot = None
+                return {"tracing": False}
+            return self._memory_report(int(args[0]) if args else MEMORY_TOP)
+
+        if cmd == "status_all":
+            return await self._status_all(float(args[0]) if args else STATUS_TIMEOUT)
+
+        if cmd == "multi":
+            if len(args) < 2:
+                raise ValueError("multi requires targets and a command")
+            return await self._multi(args[0], args[1], list(args[2:]))
+
+        if cmd == "stats":
+            snapshot = self._stats.snapshot()
+            snapshot["caches"] = {name: c.stats() for name, c in self._caches().items()}
+            snapshot["pool"] = self._pool_snapshot()
+            if args and args[0] in (True, "reset"):
+                self._stats.reset()
+            return snapshot
+
         if cmd == "get_config_value":
             if len(args) < 2:
                 raise ValueError("get_config_value requires device_id and key")
-            cfg = load_config()
-            entry = find_device(cfg, args[0])
+            entry = self._config.find(args[0])
             if entry is None:
                 raise ValueError(f"Device '{args[0]}' not found")
             return {"value": entry.get("config", {}).get(args[1])}
@@ -314,59 +2475,105 @@ class FTVDaemon:
         if cmd == "set_config_value":
             if len(args) < 3:
                 raise ValueError("set_config_value requires device_id, key, value_json")
-            cfg = load_config()
-            entry = find_device(cfg, args[0])
+            cfg = self._config.get()
+            entry = self._config.find(args[0])
             if entry is None:
                 raise ValueError(f"Device '{args[0]}' not found")
             if "config" not in entry:
                 entry["config"] = {}
             entry["config"][args[1]] = json.loads(args[2])
-            save_config(cfg)
+            self._config.save(cfg)
             return {"result": "ok"}
 
         if cmd == "select_device":
             if not args:
                 raise ValueError("select_device requires device_id")
-            cfg = load_config()
+            cfg = self._config.get()
             cfg["selected"] = args[0]
-            save_config(cfg)
+            self._config.save(cfg)
+            self._prewarm_selected()
             return {"selected": args[0]}
 
         if cmd == "remove_device":
             if not args:
                 raise ValueError("remove_device requires device_id")
             device_id = args[0]
-            cfg = load_config()
+            cfg = self._config.get()
             cfg["devices"] = [d for d in cfg.get("devices", []) if d["id"] != device_id]
             if cfg.get("selected") == device_id:
                 remaining = cfg.get("devices", [])
                 cfg["selected"] = remaining[0]["id"] if remaining else None
-            save_config(cfg)
+            self._config.save(cfg)
+            self._metadata_subs.pop(device_id, None)
+            self._last_metadata.pop(device_id, None)
+            self._details_cache.discard(device_id)
+            self._active_pairings.discard(device_id)
+            self._pair_ports_cache.discard(device_id)
+            self._status_cache.discard(device_id)
             await self._close_connection(device_id)
+            self._forget_device(device_id)
+            lock = self._conn_locks.pop(device_id)
+            if lock is not None and self._keep_conn_lock(device_id, lock):
+                self._conn_locks[device_id] = lock   # still in use; LRU will drop it
             return {"removed": device_id}
 
         if cmd == "scan_devices":
+            # Optional args[0]: answer from the discovery cache when it holds
+            # Apple TVs seen within that many seconds.
+            cfg = self._config.get()
+            known_ids = {d["id"] for d in cfg.get("devices", [])}
+            if args:
+                cached = {
+                    ident: e for ident, e in self._discovery.fresh(float(args[0])).items()
+                    if is_tvos(e)
+                }
+                if cached:
+                    return {
+                        "devices": [
+                            _cached_scan_entry(ident, e, known_ids)
+                            for ident, e in cached.items()
+                        ],
+                        "cached": True,
+                    }
+            if self._directory is not None and self._directory.running:
+                listed = [
+                    _cached_scan_entry(ident, e, known_ids)
+                    for ident, e in self._directory.devices().items()
+                    if is_tvos(e)
+                ]
+                # Empty right after startup or where multicast is filtered:
+                # fall through to an active scan.
+                if listed:
+                    return {"devices": listed, "directory": True}
+
             import pyatv as _pyatv
-            from pyatv.const import OperatingSystem
             loop = asyncio.get_running_loop()
-            found = await _pyatv.scan(loop, timeout=5)
-            cfg = load_config()
-            known_ids = {d["id"] for d in cfg.get("devices", [])}
+            found = await _pyatv.scan(loop, timeout=SCAN_TIMEOUT)
+            self._discovery.record(found)
             # Filter to only include Apple TVs (tvOS devices)
-            apple_tvs = [
-                a for a in found
-                if a.device_info and a.device_info.operating_system == OperatingSystem.TvOS
-            ]
             return {
-                "devices": [
-                    {
-                        "name":    str(a.name),
-                        "id":      a.identifier,
-                        "address": str(a.address),
-                        "known":   a.identifier in known_ids,
-                    }
-                    for a in apple_tvs
-                ]
+                "devices": [_scan_entry(a, known_ids) for a in found if _is_apple_tv(a)]
+            }
+
+        if cmd == "scan_stream":
+            # args: [timeout_seconds?, [protocol names]?]
+            timeout = float(args[0]) if args and args[0] is not None else SCAN_TIMEOUT
+            protocols = _scan_protocols(args[1] if len(args) > 1 else SCAN_PROTOCOLS)
+            return await self._stream_scan(protocols, timeout)
+
+        if cmd == "sweep_devices":
+            # args: [cidrs (string or list), [ports]?]
+            if not args:
+                raise ValueError("sweep_devices requires one or more CIDR ranges")
+            ports = tuple(int(p) for p in args[1]) if len(args) > 1 else SWEEP_PORTS
+            known_ids = {d["id"] for d in self._config.get().get("devices", [])}
+            started = time.monotonic()
+            found, responders = await sweep(args[0], ports)
+            self._discovery.record(found)
+            return {
+                "devices": [_scan_entry(a, known_ids) for a in found if _is_apple_tv(a)],
+                "responders": [{"address": h, "port": p} for h, p in responders],
+                "elapsed_ms": round((time.monotonic() - started) * 1000),
             }
 
         if cmd == "device_details":
@@ -374,8 +2581,8 @@ class FTVDaemon:
                 raise ValueError("device_details requires device_id")
 
             device_id = args[0]
-            cfg = load_config()
-            entry = find_device(cfg, device_id)
+            cfg = self._config.get()
+            entry = self._config.find(device_id)
             if entry is None:
                 entry = {
                     "id": device_id,
@@ -395,16 +2602,25 @@ class FTVDaemon:
                 },
             }
 
-            # Use prefetched device_info when available (populated on connect)
-            if device_id in self._details_cache:
-                details.update(self._details_cache[device_id])
+            # Use prefetched device_info when available (populated on connect,
+            # by the mDNS directory, or by any recent scan, including ones run
+            # by ftv_setup.py).
+            cached = self._directory_entry(device_id) or self._discovery.get(device_id)
+            info = self._details_cache.get(device_id)
+            if info is not None:
+                details.update(info)
+                if not details.get("model") and cached is not None:
+                    details.update(cached["device_info"])
+            elif cached is not None:
+                self._details_cache[device_id] = dict(cached["device_info"])
+                details.update(cached["device_info"])
             else:
                 try:
-                    config = await self._build_config(entry)
+                    config, _source = await self._build_config(entry)
                 except Exception:
                     config = None
                 if config is not None:
-                    info = _extract_device_info(config)
+                    info = extract_device_info(config)
                     self._details_cache[device_id] = info
                     details.update(info)
 
@@ -418,13 +2634,10 @@ class FTVDaemon:
             loop = asyncio.get_running_loop()
             device_id, address, proto_name = args[0], args[1], args[2]
             
-            atvs = await pyatv.scan(loop, hosts=[address], timeout=5)
-            if not atvs:
-                atvs = await pyatv.scan(loop, identifier=device_id, timeout=5)
-            if not atvs:
+            config, _path = await self._discover(device_id, address, any_at_host=True)
+            if config is None:
                 raise ValueError("Device not found")
                 
-            config = atvs[0]
             proto_map = {
                 "mrp": Protocol.MRP,
                 "companion": Protocol.Companion,
@@ -436,14 +2649,11 @@ class FTVDaemon:
             pairing = await pyatv.pair(config, proto_map[proto_name], loop)
             await pairing.begin()
             
-            if not hasattr(self, "_active_pairings"):
-                self._active_pairings = {}
+            # Replaces (and closes) any earlier session for this device.
             self._active_pairings[device_id] = (pairing, config)
 
             # Cache service ports so pair_save can persist them for future
             # cross-subnet connections without needing another scan.
-            if not hasattr(self, "_pair_ports_cache"):
-                self._pair_ports_cache = {}
             self._pair_ports_cache[device_id] = _extract_service_ports(config)
 
             return {"status": "waiting_for_pin"}
@@ -453,26 +2663,28 @@ class FTVDaemon:
                 raise ValueError("pair_pin requires device_id and pin")
             device_id, pin_str = args[0], args[1]
             
-            if not hasattr(self, "_active_pairings") or device_id not in self._active_pairings:
+            session = self._active_pairings.pop(device_id)
+            if session is None:
                 raise ValueError("No active pairing session for device")
                 
-            pairing, config = self._active_pairings[device_id]
+            pairing, config = session
             if not str(pin_str).isdigit():
                 await pairing.close()
-                del self._active_pairings[device_id]
                 raise ValueError("Invalid PIN")
                 
-            pairing.pin(int(pin_str))
-            await pairing.finish()
+            try:
+                pairing.pin(int(pin_str))
+                await pairing.finish()
+            except Exception:
+                await pairing.close()
+                raise
             
             if pairing.has_paired:
                 cred = str(pairing.service.credentials)
                 await pairing.close()
-                del self._active_pairings[device_id]
                 return {"credentials": cred, "name": config.name}
             else:
                 await pairing.close()
-                del self._active_pairings[device_id]
                 raise ValueError("Pairing failed (wrong PIN?)")
 
         if cmd == "pair_save":
@@ -480,8 +2692,8 @@ class FTVDaemon:
                 raise ValueError("pair_save requires device_id, address, name, credentials_dict")
             device_id, address, name, creds_dict = args[0], args[1], args[2], args[3]
             
-            cfg = load_config()
-            existing = next((d for d in cfg.get("devices", []) if d["id"] == device_id), None)
+            cfg = self._config.get()
+            existing = self._config.find(device_id)
             
             entry = {
                 "name": name,
@@ -493,9 +2705,7 @@ class FTVDaemon:
 
             # Carry over cached service ports so cross-subnet connections work
             # without requiring the device to be reachable via mDNS first.
-            cached_ports = None
-            if hasattr(self, "_pair_ports_cache"):
-                cached_ports = self._pair_ports_cache.pop(device_id, None)
+            cached_ports = self._pair_ports_cache.pop(device_id)
             if cached_ports:
                 entry["services"] = cached_ports
             elif existing and existing.get("services"):
@@ -517,7 +2727,7 @@ class FTVDaemon:
             if cfg.get("selected") is None:
                 cfg["selected"] = device_id
                 
-            save_config(cfg)
+            self._config.save(cfg)
             return {"status": "saved"}
 
         # ── Commands that require a live connection ────────────────────────────
@@ -529,12 +2739,12 @@ class FTVDaemon:
         if cmd == "power_state":
             async def _fn(atv):
                 return {"on": atv.power.power_state == PowerState.On}
-            return await self._with_retry(device_id, _fn)
+            return await self._with_retry(device_id, _fn, cmd)
 
         if cmd == "get_volume":
             async def _fn(atv):
                 return {"volume": atv.audio.volume}
-            return await self._with_retry(device_id, _fn)
+            return await self._with_retry(device_id, _fn, cmd)
 
         if cmd == "set_volume":
             if len(args) < 2:
@@ -547,47 +2757,46 @@ class FTVDaemon:
             async def _fn(atv, _level=level):
                 await atv.audio.set_volume(_level)
                 return {"volume": _level}
-            return await self._with_retry(device_id, _fn)
+            return await self._with_retry(device_id, _fn, cmd)
 
         if cmd == "volume_mute":
             async def _fn(atv):
                 try:
                     await atv.audio.set_volume(0.0)
                     return {"volume": 0}
-                except Exception:
+                except Exception as e:
+                    if _classify_error(e) == ERROR_TRANSPORT:
+                        raise
                     # Fallback: step volume down several times.
                     for _ in range(10):
                         await atv.audio.volume_down()
                     return {"volume": None}
-            return await self._with_retry(device_id, _fn)
+            return await self._with_retry(device_id, _fn, cmd)
 
         if cmd == "get_metadata":
             async def _fn(atv):
-                p = await atv.metadata.playing()
-                series = ""
-                sn = getattr(p, "series_name", None)
-                if sn:
-                    series = sn
-                    season  = getattr(p, "season_number",  None)
-                    episode = getattr(p, "episode_number", None)
-                    if season is not None and episode is not None:
-                        series += f" S{season}E{episode}"
-                    elif episode is not None:
-                        series += f" E{episode}"
-                duration = getattr(p, "total_time", None) or getattr(p, "duration", None)
-                app = getattr(p, "app", None)
-                app_id = app.identifier if (app and hasattr(app, "identifier")) else None
-                return {
-                    "device_state": str(p.device_state),
-                    "title":    p.title  or "",
-                    "artist":   p.artist or "",
-                    "album":    p.album  or "",
-                    "series":   series,
-                    "position": p.position,
-                    "duration": duration,
-                    "app_id":   app_id,
-                }
-            return await self._with_retry(device_id, _fn)
+                return _format_playing(await atv.metadata.playing())
+            return await self._with_retry(device_id, _fn, cmd)
+
+        if cmd == "subscribe_metadata":
+            async def _fn(atv):
+                self._attach_push_updater(device_id, atv)
+                metadata = _format_playing(await atv.metadata.playing())
+                self._last_metadata[device_id] = metadata
+                return {"subscribed": True, "metadata": metadata}
+            return await self._with_retry(device_id, _fn, cmd)
+
+        if cmd == "unsubscribe_metadata":
+            listener = self._metadata_subs.pop(device_id, None)
+            self._last_metadata.pop(device_id, None)
+            atv = self._connections.get(device_id)
+            if listener is not None and atv is not None:
+                try:
+                    atv.push_updater.stop()
+                    atv.push_updater.listener = None
+                except Exception:
+                    pass
+            return {"subscribed": False}
 
         if cmd == "get_artwork":
             async def _fn(atv):
@@ -598,7 +2807,7 @@ class FTVDaemon:
                 with open(path, "wb") as f:
                     f.write(bytes(artwork.bytes))
                 return {"artwork_path": path, "mimetype": artwork.mimetype or "image/jpeg"}
-            return await self._with_retry(device_id, _fn)
+            return await self._with_retry(device_id, _fn, cmd)
 
         if cmd == "list_apps":
             async def _fn(atv):
@@ -607,7 +2816,7 @@ class FTVDaemon:
                     {"name": a.name, "id": a.identifier}
                     for a in sorted(apps, key=lambda x: x.name.lower())
                 ]}
-            return await self._with_retry(device_id, _fn)
+            return await self._with_retry(device_id, _fn, cmd)
 
         if cmd == "launch_app":
             if len(args) < 2:
@@ -620,14 +2829,16 @@ class FTVDaemon:
                 except Exception as _e:
                     ename = type(_e).__name__
                     print(f"[launch_app] '{_bundle}' raised {ename}: {_e}", file=sys.stderr, flush=True)
-                    if "NotSupportedError" in ename or "NotImplementedError" in ename:
-                        raise ValueError(
+                    kind = _classify_error(_e)
+                    if kind == ERROR_UNSUPPORTED:
+                        raise CommandFailed(
                             f"App launch not supported for '{_bundle}' "
-                            "(Companion protocol may not be paired or app is restricted)"
+                            "(Companion protocol may not be paired or app is restricted)",
+                            kind,
                         ) from _e
-                    raise ValueError(f"Launch failed for '{_bundle}': {_e}") from _e
+                    raise CommandFailed(f"Launch failed for '{_bundle}': {_e}", kind) from _e
                 return {}
-            return await self._with_retry(device_id, _fn)
+            return await self._with_retry(device_id, _fn, cmd)
 
         if cmd == "keyboard_set":
             if len(args) < 2:
@@ -635,17 +2846,10 @@ class FTVDaemon:
             async def _fn(atv, _text=args[1]):
                 await atv.keyboard.text_set(_text)
                 return {}
-            return await self._with_retry(device_id, _fn)
+            return await self._with_retry(device_id, _fn, cmd)
 
         # ── Remote-control and power commands ─────────────────────────────────
 
-        REMOTE_COMMANDS = {
-            "play_pause", "stop", "volume_up", "volume_down",
-            "skip_next", "skip_prev", "next_track", "prev_track",
-            "select", "select_hold", "up", "down", "left", "right",
-            "menu", "home", "top_menu",
-            "power_on", "power_off",
-        }
         if cmd in REMOTE_COMMANDS:
             async def _fn(atv, _cmd=cmd):
                 import pyatv.const
@@ -674,21 +2878,156 @@ class FTVDaemon:
                 }
                 await command_map[_cmd]()
                 return {}
-            return await self._with_retry(device_id, _fn)
+            return await self._with_retry(device_id, _fn, cmd)
 
         raise ValueError(f"Unknown command: '{cmd}'")
 
     # ── Per-message executor ───────────────────────────────────────────────────
 
-    async def _execute(self, msg):
+    async def _handle(self, cmd, args, priority=PRIORITY_INTERACTIVE):
+        """Route one request through coalescing and its device lane."""
+        if cmd in COALESCED_COMMANDS:
+            key = _coalesce_key(cmd, args)
+            return await self._coalescer.submit(
+                key, _bind_stages(lambda: self._schedule(cmd, args, priority))
+            )
+        return await self._schedule(cmd, args, priority)
+
+    async def _schedule(self, cmd, args, priority):
+        if cmd in DEVICE_COMMANDS and args:
+            self._recent_devices[args[0]] = True
+            self._recent_devices.move_to_end(args[0])
+            if len(self._recent_devices) > RECENT_DEVICES_LIMIT:
+                self._recent_devices.popitem(last=False)
+            key = None
+            if priority == PRIORITY_BACKGROUND:
+                key = (cmd, json.dumps(args))
+            return await self._lanes.submit(
+                args[0], _bind_stages(lambda: self._dispatch(cmd, args), "dispatch"),
+                priority, key
+            )
+        started = time.monotonic()
+        try:
+            return await self._dispatch(cmd, args)
+        finally:
+            _trace_span("dispatch", started)
+
+    async def _run_request(self, msg, group=None, deadline=None, received=None):
+        """Run one request and return its response dict (not yet written).
+
+        The work runs as its own task, registered under the request id (or
+        the enclosing batch's id, `group`) so `cancel` can stop it, and is
+        cancelled when the request's deadline passes.
+        """
         id_ = msg.get("id", "?")
         cmd  = msg.get("cmd", "")
         args = msg.get("args", [])
+        if not isinstance(cmd, str):
+            # Rejected before the command is used as a key (priority, stats,
+            # trace), where a list or dict would raise outside the try below.
+            return self._response(id_, error=TypeError(f"'cmd' must be a string, not {type(cmd).__name__}"))
+        priority = _request_priority(msg)
+        started = received if received is not None else time.monotonic()
+        key = str(group if group is not None else id_)
+        work = None
+        stages = {"queue": time.monotonic() - started}
+        _STAGES.set(stages)   # copied into the work task's context below
+        trace = self._tracer.request(id_, cmd, args) if self._tracer.enabled else None
+        _TRACE.set(trace)
+        _trace_span("receive", started)
         try:
-            result = await self._dispatch(cmd, args)
-            self._respond(id_, result=result)
+            deadline = _request_deadline(msg, deadline, started)
+            if deadline is not None and deadline <= time.monotonic():
+                raise RequestExpired(f"expired: '{cmd}' waited past its deadline")
+            work = asyncio.get_running_loop().create_task(self._handle(cmd, args, priority))
+            self._inflight.setdefault(key, []).append(work)
+            timeout = None if deadline is None else deadline - time.monotonic()
+            done, _pending = await asyncio.wait({work}, timeout=timeout)
+            if not done:
+                work.cancel()
+                raise RequestExpired(f"expired: '{cmd}' exceeded deadline_ms")
+            if work.cancelled():
+                raise RequestCancelled(f"cancelled: '{cmd}'")
+            response = self._response(id_, result=work.result())
         except Exception as e:
-            self._respond(id_, error=e)
+            response = self._response(id_, error=e)
+        finally:
+            tasks = self._inflight.get(key)
+            if work is not None and tasks is not None:
+                tasks.remove(work)
+                if not tasks:
+                    del self._inflight[key]
+        elapsed = (time.monotonic() - started) * 1000
+        self._latency[priority].record(elapsed)
+        self._stats.record(cmd, elapsed, stages, "error" not in response)
+        if trace is not None:
+            trace[0].span("request", started, None, trace[1],
+                          {**trace[2], "ok": "error" not in response, "kind": response.get("kind")})
+            trace[0].flush()
+        return response
+
+    async def _run_batch(self, msg, received=None):
+        """Run a batch's sub-requests concurrently; answer with one message.
+
+        Request:  {"id": "5", "cmd": "batch", "args": [{"id": "a", "cmd": ...}, ...]}
+        Response: {"id": "5", "result": {"responses": [{"id": "a", "result": ...}, ...]}}
+        Sub-requests without an id are numbered by position.  `cancel` and
+        deadline_ms apply to the batch as a whole (a sub-request may also
+        carry its own, shorter deadline_ms).
+        """
+        subs = msg.get("args", [])
+        if not isinstance(subs, list) or not all(isinstance(m, dict) for m in subs):
+            return self._response(msg.get("id", "?"), error="batch requires a list of request objects")
+        for i, sub in enumerate(subs):
+            sub.setdefault("id", str(i))
+            if sub.get("cmd") == "batch":
+                return self._response(msg.get("id", "?"), error="batch requests cannot be nested")
+        try:
+            deadline = _request_deadline(msg, received=received)
+        except (TypeError, ValueError) as e:
+            return self._response(msg.get("id", "?"), error=e)
+
+        async def _sub(sub):
+            # Each sub-request takes its own in-flight slot, like a request.
+            async with self._slots:
+                return await self._run_request(sub, group=msg.get("id", "?"),
+                                               deadline=deadline, received=received)
+
+        responses = await asyncio.gather(*(_sub(sub) for sub in subs))
+        return self._response(msg.get("id", "?"), result={"responses": list(responses)})
+
+    async def _execute(self, msg, received=None, slot=False):
+        """Run a request or batch and write its response.
+
+        slot: the caller acquired an in-flight slot for this message; it is
+        released here.  A batch hands its slot back at once, because each of
+        its sub-requests takes one of its own.
+        """
+        try:
+            if msg.get("cmd") == "batch":
+                if slot:
+                    self._slots.release()
+                    slot = False
+                response = await self._run_batch(msg, received)
+            else:
+                response = await self._run_request(msg, received=received)
+            self._write(response)
+            if self._out is not None:
+                # Hold this in-flight slot until the client is reading again.
+                await self._out.wait_writable()
+        finally:
+            if slot:
+                self._slots.release()
+
+    async def _admit_loop(self):
+        """Start queued requests, keeping at most MAX_IN_FLIGHT running."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            received, msg = await self._admission.get()
+            task = loop.create_task(self._execute(msg, received, slot=True))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
 
     # ── Main read loop ─────────────────────────────────────────────────────────
 
@@ -697,22 +3036,82 @@ class FTVDaemon:
         reader = asyncio.StreamReader()
         protocol = asyncio.StreamReaderProtocol(reader)
         await loop.connect_read_pipe(lambda: protocol, sys.stdin)
-
-        async for raw in reader:
-            line = raw.decode().strip()
-            if not line:
+        out = _OutputWriter()
+        try:
+            await out.start(sys.stdout.buffer)
+            self._out = out
+        except (ValueError, OSError) as e:
+            # e.g. stdout redirected to a regular file; keep synchronous writes.
+            print(f"[daemon] buffered stdout unavailable: {e}", file=sys.stderr, flush=True)
+        self._admission = asyncio.Queue(ADMISSION_QUEUE_LIMIT)
+        self._slots = asyncio.Semaphore(MAX_IN_FLIGHT)
+        admit = loop.create_task(self._admit_loop())
+        keepalive = loop.create_task(self._keepalive_loop())
+        if MDNS_LISTENER:
+            await self._start_directory()
+        if TRACE:
+            self._tracer.start()
+        if TRACEMALLOC:
+            import tracemalloc
+            tracemalloc.start()
+        self._prewarm_selected()
+
+        while True:
+            try:
+                body = await self._codec.read(reader)
+            except ValueError as e:
+                self._respond("?", error=e)
+                continue
+            if body is None:
+                break
+            if not body:
                 continue
             try:
-                msg = json.loads(line)
-            except json.JSONDecodeError as e:
-                self._respond("?", error=f"Invalid JSON: {e}")
+                msg = self._codec.decode(body)
+            except ValueError as e:
+                self._respond("?", error=f"Invalid {self._codec.name} message: {e}")
                 continue
-            # Fire-and-forget so multiple commands can be in-flight concurrently
-            asyncio.create_task(self._execute(msg))
-
-        # stdin closed — shut down open connections cleanly
+            if not isinstance(msg, dict):
+                self._respond("?", error="Request must be an object")
+                continue
+            if msg.get("cmd") == "hello":
+                # Handled inline so no later message is read with the old codec.
+                try:
+                    self._negotiate(msg)
+                except Exception as e:
+                    self._respond(msg.get("id", "?"), error=e)
+                continue
+            if msg.get("cmd") == "cancel":
+                # Never queued behind the work it is meant to stop.
+                task = loop.create_task(self._execute(msg))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+                continue
+            # Blocks (and so stops reading stdin) while the queue is full.
+            await self._admission.put((time.monotonic(), msg))
+            self._admission_peak = max(self._admission_peak, self._admission.qsize())
+
+        # stdin closed — answer what was already read, then shut down
+        # open connections cleanly.
+        grace = time.monotonic() + SHUTDOWN_GRACE
+        while (self._admission.qsize() or self._running) and time.monotonic() < grace:
+            if self._running:
+                await asyncio.wait(set(self._running), timeout=grace - time.monotonic())
+            else:
+                await asyncio.sleep(0)
+        admit.cancel()
+        keepalive.cancel()
+        if self._directory is not None:
+            await self._directory.stop()
+        for task in [*self._reconnect_tasks.values(), *self._prewarm_tasks.values()]:
+            task.cancel()
         for device_id in list(self._connections):
             await self._close_connection(device_id)
+        if self._out is not None:
+            await self._out.close()
+        self._tracer.stop()
+        if self._profile is not None:
+            self._profile_stop(PROFILE_PATH)
 
 
 if __name__ == "__main__":
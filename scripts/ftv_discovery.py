@@ -0,0 +1,499 @@
+"""
+ftv_discovery.py — Shared on-disk cache of Fruit TV discovery results.
+
+ftv_daemon.py, ftv_control.py and ftv_setup.py all import this module (it is
+installed next to them).  Every scan records what it found, and anything that
+needs to locate a device (pairing, device details, reconnects without stored
+ports) checks the cache first instead of paying another 5-second pyatv.scan.
+
+Cache file: ~/.config/fruittv-remote/discovery.json
+  {"devices": {"<identifier>": {
+      "id": "<identifier>",
+      "name": "Living Room",
+      "address": "192.168.1.20",
+      "identifiers": ["<identifier>", "<other ids for the same device>"],
+      "services": {"companion": {"identifier": "...", "port": 49153, "properties": {...}}, ...},
+      "device_info": {"model": "...", "operating_system": "TvOS", ...},
+      "updated": 1700000000.0
+  }}}
+
+Entries older than DEFAULT_TTL seconds are ignored by lookups.
+
+DeviceDirectory is the daemon's optional live counterpart: a long-lived
+passive zeroconf browser that keeps entries of the same shape in memory,
+current to the latest mDNS announcement.  MdnsBrowser is the browse-and-scan
+pass it shares with the daemon's streaming scans.
+
+sweep() finds devices mDNS multicast can't reach (other VLANs/subnets): it
+TCP-probes the Companion and MRP ports across CIDR ranges, then runs a
+unicast pyatv.scan only against the hosts that answered.
+"""
+
+import asyncio
+import collections
+import json
+import os
+import sys
+import time
+
+CONFIG_DIR = os.path.expanduser("~/.config/fruittv-remote")
+CACHE_PATH = os.path.join(CONFIG_DIR, "discovery.json")
+
+DEFAULT_TTL = 600  # seconds
+
+# MdnsBrowser: after an announcement, wait this long before scanning so the
+# device's other services arrive in the same pass.
+BROWSE_SETTLE = 0.15  # seconds for a device's other services to arrive
+
+# DeviceDirectory limits: at most DIRECTORY_MAX_DEVICES entries (least recently
+# seen evicted first); a device missing from the browser's cache for
+# DIRECTORY_EXPIRY seconds is dropped.  The cache is re-checked every
+# DIRECTORY_SWEEP_INTERVAL seconds even when nothing was announced.
+DIRECTORY_MAX_DEVICES = 64
+DIRECTORY_EXPIRY = 180
+DIRECTORY_SWEEP_INTERVAL = 60
+
+# Subnet sweep: ports probed per host (Companion, then MRP), probes in flight,
+# per-connect timeout, and a cap on hosts per sweep (a /20).
+SWEEP_PORTS = (49153, 49152)
+SWEEP_CONCURRENCY = 256
+SWEEP_CONNECT_TIMEOUT = 0.5
+SWEEP_SCAN_TIMEOUT = 3
+SWEEP_MAX_HOSTS = 4096
+
+
+# ── pyatv config helpers ──────────────────────────────────────────────────────
+
+def file_signature(path):
+    """(mtime_ns, inode, size) of path, or None; changes when it is rewritten."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+
+def _normalize_os_name(value):
+    if value is None:
+        return None
+    text = str(value)
+    if "." in text:
+        text = text.split(".")[-1]
+    return text
+
+
+def _pick_first_nonempty(*values):
+    for value in values:
+        if value is not None and str(value) != "":
+            return str(value)
+    return None
+
+
+def extract_device_info(config):
+    """Extract network-discovered device info from a pyatv config object."""
+    result = {
+        "address": str(getattr(config, "address", "") or ""),
+    }
+    info = getattr(config, "device_info", None)
+    if info is not None:
+        result["model"] = _pick_first_nonempty(
+            getattr(info, "model_str", None),
+            getattr(info, "model", None),
+        )
+        result["operating_system"] = _normalize_os_name(
+            getattr(info, "operating_system", None)
+        )
+        result["os_version"] = _pick_first_nonempty(
+            getattr(info, "version", None),
+            getattr(info, "operating_system_version", None),
+        )
+        result["build_number"] = _pick_first_nonempty(
+            getattr(info, "build_number", None)
+        )
+        result["mac"] = _pick_first_nonempty(
+            getattr(info, "mac", None),
+            getattr(info, "mac_address", None),
+        )
+    return result
+
+
+def is_tvos(entry):
+    """True when a cache entry describes a tvOS device (an actual Apple TV)."""
+    return (entry.get("device_info") or {}).get("operating_system") == "TvOS"
+
+
+def _entry_from_config(config, now):
+    services = {}
+    for svc in config.services:
+        services[svc.protocol.name.lower()] = {
+            "identifier": svc.identifier,
+            "port": svc.port,
+            "properties": dict(svc.properties),
+        }
+    return {
+        "id": config.identifier,
+        "name": str(config.name),
+        "address": str(config.address),
+        "identifiers": [i for i in config.all_identifiers if i],
+        "services": services,
+        "device_info": extract_device_info(config),
+        "updated": now,
+    }
+
+
+def _key_for(devices, identifier):
+    """Key of the entry that lists identifier among its ids, or None."""
+    if identifier in devices:
+        return identifier
+    for key, entry in devices.items():
+        if identifier in entry.get("identifiers", ()):
+            return key
+    return None
+
+
+def to_config(entry):
+    """Rebuild a pyatv AppleTV config (no credentials) from a cache entry."""
+    from ipaddress import IPv4Address
+    from pyatv.conf import AppleTV, ManualService
+    from pyatv.const import Protocol, PairingRequirement
+
+    protocols = {p.name.lower(): p for p in Protocol}
+    config = AppleTV(IPv4Address(entry["address"]), entry.get("name", ""))
+    for proto_name, svc in entry.get("services", {}).items():
+        protocol = protocols.get(proto_name)
+        if protocol is None:
+            continue
+        config.add_service(ManualService(
+            svc.get("identifier"),
+            protocol,
+            svc["port"],
+            svc.get("properties") or {},
+            pairing_requirement=PairingRequirement.Optional,
+        ))
+    return config
+
+
+# ── Cache ─────────────────────────────────────────────────────────────────────
+
+class DiscoveryCache:
+    """discovery.json, re-read only when another process has rewritten it."""
+
+    def __init__(self, path=CACHE_PATH, ttl=DEFAULT_TTL):
+        self._path = path
+        self.ttl = ttl
+        self._devices = {}
+        self._sig = None
+
+    def _load(self):
+        sig = file_signature(self._path)
+        if sig == self._sig:
+            return self._devices
+        devices = {}
+        if sig is not None:
+            try:
+                with open(self._path) as f:
+                    devices = json.load(f).get("devices", {})
+            except (json.JSONDecodeError, OSError, AttributeError):
+                devices = {}
+        self._devices, self._sig = devices, sig
+        return devices
+
+    def _save(self, devices):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp = f"{self._path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"devices": devices}, f, indent=2)
+        os.replace(tmp, self._path)
+        self._devices, self._sig = devices, file_signature(self._path)
+
+    def __len__(self):
+        """Entries currently held in memory (as of the last read)."""
+        return len(self._devices)
+
+    def _is_fresh(self, entry, max_age):
+        max_age = self.ttl if max_age is None else max_age
+        return time.time() - entry.get("updated", 0) <= max_age
+
+    def record(self, configs):
+        """Store pyatv scan results; failures to write are not fatal."""
+        configs = [c for c in configs if c.identifier]
+        if not configs:
+            return
+        devices = dict(self._load())
+        now = time.time()
+        for config in configs:
+            entry = _entry_from_config(config, now)
+            # Drop older entries for the same device under another identifier.
+            for ident in entry["identifiers"]:
+                if ident != config.identifier:
+                    devices.pop(ident, None)
+            devices[config.identifier] = entry
+        try:
+            self._save(devices)
+        except OSError:
+            self._devices = devices
+
+    def forget(self, identifier):
+        devices = dict(self._load())
+        key = _key_for(devices, identifier)
+        if key is None:
+            return
+        del devices[key]
+        try:
+            self._save(devices)
+        except OSError:
+            self._devices = devices
+
+    def get(self, identifier, max_age=None):
+        """Return the fresh entry for identifier (any of its ids), or None."""
+        devices = self._load()
+        key = _key_for(devices, identifier)
+        if key is None or not self._is_fresh(devices[key], max_age):
+            return None
+        return devices[key]
+
+    def find_by_address(self, address, max_age=None):
+        for entry in self._load().values():
+            if entry.get("address") == address and self._is_fresh(entry, max_age):
+                return entry
+        return None
+
+    def fresh(self, max_age=None):
+        """Return {identifier: entry} for every entry younger than max_age."""
+        return {
+            key: entry for key, entry in self._load().items()
+            if self._is_fresh(entry, max_age)
+        }
+
+
+# ── Subnet sweep ──────────────────────────────────────────────────────────────
+
+def sweep_hosts(cidrs, max_hosts=SWEEP_MAX_HOSTS):
+    """Expand CIDR strings (or bare addresses) into a de-duplicated host list."""
+    from ipaddress import ip_network
+
+    if isinstance(cidrs, str):
+        cidrs = cidrs.replace(",", " ").split()
+    hosts = {}
+    for cidr in cidrs:
+        network = ip_network(cidr, strict=False)
+        if network.version != 4:
+            raise ValueError(f"Only IPv4 ranges can be swept: {cidr}")
+        if network.num_addresses > max_hosts:
+            raise ValueError(f"{cidr} has {network.num_addresses} addresses (max {max_hosts})")
+        for host in (network.hosts() if network.num_addresses > 1 else [network.network_address]):
+            hosts[str(host)] = True
+        if len(hosts) > max_hosts:
+            raise ValueError(f"Sweep covers more than {max_hosts} hosts")
+    return list(hosts)
+
+
+async def _port_open(host, port, timeout):
+    try:
+        _reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def probe_hosts(hosts, ports=SWEEP_PORTS, concurrency=SWEEP_CONCURRENCY,
+                      timeout=SWEEP_CONNECT_TIMEOUT):
+    """TCP-probe hosts with bounded concurrency; return [(host, port), ...].
+
+    A host's ports are probed together, so a silent host costs one timeout;
+    it is reported with the first of `ports` that accepted a connection.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _probe(host):
+        async with semaphore:
+            is_open = await asyncio.gather(*(_port_open(host, p, timeout) for p in ports))
+        return next(((host, p) for p, ok in zip(ports, is_open) if ok), None)
+
+    results = await asyncio.gather(*(_probe(h) for h in hosts))
+    return [r for r in results if r is not None]
+
+
+async def sweep(cidrs, ports=SWEEP_PORTS, concurrency=SWEEP_CONCURRENCY,
+                timeout=SWEEP_CONNECT_TIMEOUT, scan_timeout=SWEEP_SCAN_TIMEOUT):
+    """Probe CIDR ranges, then unicast-scan only the responders.
+
+    Returns (configs, responders): pyatv configs for responders that answered
+    the unicast mDNS scan, and every (host, port) that accepted a connection
+    (so callers can fall back to pairing by IP when mDNS is filtered too).
+    """
+    import pyatv
+
+    responders = await probe_hosts(sweep_hosts(cidrs), ports, concurrency, timeout)
+    if not responders:
+        return [], []
+    configs = await pyatv.scan(
+        asyncio.get_running_loop(),
+        hosts=[host for host, _port in responders],
+        timeout=scan_timeout,
+    )
+    return configs, responders
+
+
+# ── mDNS browser ──────────────────────────────────────────────────────────────
+
+class MdnsBrowser:
+    """A zeroconf browser for the service types of `protocols`, plus scan passes.
+
+    wait() returns once a burst of announcements has settled (BROWSE_SETTLE);
+    scan() then runs a pyatv.scan pass against the browser's record cache,
+    which costs milliseconds and no network traffic for services already
+    resolved, so results carry pyatv's own identifiers and tvOS detection.
+    """
+
+    def __init__(self, protocols, settle=BROWSE_SETTLE):
+        self._protocols = set(protocols)
+        self._settle = settle
+        self._changed = None
+        self._aiozc = None
+        self._browser = None
+
+    async def start(self):
+        """Start browsing; raises ImportError/OSError when zeroconf is unusable."""
+        from pyatv.protocols import PROTOCOLS
+        from zeroconf import ServiceStateChange
+        from zeroconf.asyncio import AsyncServiceBrowser, AsyncZeroconf
+
+        loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+
+        def _on_service(zeroconf, service_type, name, state_change):
+            if state_change is not ServiceStateChange.Removed:
+                loop.call_soon_threadsafe(self._changed.set)
+
+        self._aiozc = AsyncZeroconf()
+        types = [f"{t}." for p in self._protocols for t in PROTOCOLS[p].scan()]
+        self._browser = AsyncServiceBrowser(
+            self._aiozc.zeroconf, types, handlers=[_on_service]
+        )
+
+    async def stop(self):
+        if self._browser is not None:
+            await self._browser.async_cancel()
+        if self._aiozc is not None:
+            await self._aiozc.async_close()
+        self._browser = self._aiozc = None
+
+    @property
+    def pending(self):
+        """True when services were announced since the last scan()."""
+        return self._changed is not None and self._changed.is_set()
+
+    async def wait(self, timeout):
+        """Wait up to timeout for announcements to settle; False on timeout."""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        await asyncio.sleep(self._settle)
+        return True
+
+    async def scan(self):
+        """Return pyatv configs for everything the browser has resolved."""
+        import pyatv
+
+        self._changed.clear()
+        return await pyatv.scan(
+            asyncio.get_running_loop(), timeout=1,
+            protocol=self._protocols, aiozc=self._aiozc,
+        )
+
+
+# ── Live directory ────────────────────────────────────────────────────────────
+
+class DeviceDirectory:
+    """In-memory device entries kept current by a passive MdnsBrowser.
+
+    Each settled burst of announcements, and every DIRECTORY_SWEEP_INTERVAL
+    seconds otherwise, refreshes the entries from a scan pass.
+    on_change(entry, old) is called whenever a device appears or its address
+    or ports change.
+    """
+
+    def __init__(self, protocols, on_change=None, max_devices=DIRECTORY_MAX_DEVICES,
+                 expiry=DIRECTORY_EXPIRY):
+        self._browser = MdnsBrowser(protocols)
+        self._on_change = on_change
+        self._max_devices = max_devices
+        self._expiry = expiry
+        self._devices = collections.OrderedDict()  # identifier -> entry, LRU first
+        self._task = None
+        self.refreshes = 0
+        self.evictions = 0
+
+    async def start(self):
+        """Start browsing; raises ImportError/OSError when zeroconf is unusable."""
+        await self._browser.start()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self._browser.stop()
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    async def _run(self):
+        while True:
+            await self._browser.wait(DIRECTORY_SWEEP_INTERVAL)
+            try:
+                await self._refresh()
+            except Exception as e:
+                print(f"[directory] refresh failed: {e}", file=sys.stderr, flush=True)
+
+    async def _refresh(self):
+        configs = await self._browser.scan()
+        self.refreshes += 1
+        now = time.time()
+        for config in configs:
+            if not config.identifier:
+                continue
+            entry = _entry_from_config(config, now)
+            for ident in entry["identifiers"]:
+                if ident != config.identifier:
+                    self._devices.pop(ident, None)
+            old = self._devices.pop(config.identifier, None)
+            self._devices[config.identifier] = entry
+            if self._on_change is not None and (
+                old is None
+                or old["address"] != entry["address"]
+                or _ports(old) != _ports(entry)
+            ):
+                self._on_change(entry, old)
+
+        for key in [k for k, e in self._devices.items() if now - e["updated"] > self._expiry]:
+            del self._devices[key]
+        while len(self._devices) > self._max_devices:
+            self._devices.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, identifier):
+        key = _key_for(self._devices, identifier)
+        return None if key is None else self._devices[key]
+
+    def find_by_address(self, address):
+        for entry in self._devices.values():
+            if entry["address"] == address:
+                return entry
+        return None
+
+    def devices(self):
+        """Return {identifier: entry} for every device currently visible."""
+        return dict(self._devices)
+
+
+def _ports(entry):
+    return {name: svc["port"] for name, svc in entry["services"].items()}
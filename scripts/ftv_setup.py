@@ -14,6 +14,8 @@ import json
 import os
 import sys
 
+from ftv_discovery import DiscoveryCache, sweep
+
 CONFIG_DIR  = os.path.expanduser("~/.config/fruittv-remote")
 CONFIG_PATH = os.path.join(CONFIG_DIR, "devices.json")
 
@@ -57,6 +59,7 @@ async def discover_devices():
     from pyatv.const import OperatingSystem
     print("Scanning network for Fruit TVs (5 second timeout)...")
     found = await pyatv.scan(asyncio.get_event_loop(), timeout=5)
+    DiscoveryCache().record(found)
     # Filter to only include Fruit TVs (tvOS devices)
     return [
         a for a in found
@@ -213,6 +216,44 @@ async def cmd_add_devices(cfg):
     save_config(cfg)
 
 
+async def cmd_sweep_devices(cfg):
+    """Probe subnet(s) for Fruit TVs on other VLANs and add chosen devices."""
+    import time
+    from pyatv.const import OperatingSystem
+
+    raw = input("Subnet(s) to sweep, e.g. 192.168.20.0/24: ").strip()
+    if not raw:
+        return
+
+    print("Probing Companion/MRP ports...")
+    started = time.monotonic()
+    try:
+        found, responders = await sweep(raw)
+    except ValueError as e:
+        print(f"  {e}")
+        return
+    print(f"  {len(responders)} host(s) answered in {time.monotonic() - started:.1f}s.")
+    DiscoveryCache().record(found)
+
+    atvs = [
+        a for a in found
+        if a.device_info and a.device_info.operating_system == OperatingSystem.TvOS
+    ]
+    if atvs:
+        await _pair_found_devices(atvs, cfg)
+        save_config(cfg)
+        return
+
+    if responders:
+        # The ports are open but unicast mDNS is filtered; pair by IP instead.
+        print("\nNo device answered mDNS. Open ports found on:")
+        for host, port in responders:
+            print(f"  {host}  (port {port})")
+        print("Use [i] to pair one of these by IP address.")
+    else:
+        print("\nNo Fruit TVs found in that range.")
+
+
 async def cmd_pair_by_ip_direct(cfg):
     """Pair directly by IP — no mDNS scan (for cross-VLAN setups)."""
     from ipaddress import IPv4Address
@@ -230,13 +271,19 @@ async def cmd_pair_by_ip_direct(cfg):
         print(f"  Invalid IP address: {ip_raw}")
         return
 
-    default_name = f"Fruit TV at {ip}"
+    # A recent scan (from any of the tools) may already know this address;
+    # if so, reuse its real identifier, name and ports.
+    cached = DiscoveryCache().find_by_address(str(ip))
+    if cached is not None:
+        print(f"  Found '{cached['name']}' at {ip} in the discovery cache.")
+
+    default_name = cached["name"] if cached else f"Fruit TV at {ip}"
     name_raw = input(f"Device name [{default_name}]: ").strip()
     name = name_raw if name_raw else default_name
 
-    # Use IP string as the device ID — we don't have the real hardware ID
-    # without mDNS, but static IPs make this stable.
-    device_id = str(ip)
+    # Without a cached scan, use the IP string as the device ID — we don't
+    # have the real hardware ID without mDNS, but static IPs make this stable.
+    device_id = cached["id"] if cached else str(ip)
 
     existing = next((d for d in cfg.get("devices", []) if d["id"] == device_id), None)
     entry = {
@@ -262,6 +309,8 @@ async def cmd_pair_by_ip_direct(cfg):
     # MRP pairing is attempted only if ATTEMPT_MRP=true env var is set AND
     # it succeeds — it's expected to fail on modern tvOS.
     COMPANION_PORT = 49153
+    if cached is not None and "companion" in cached["services"]:
+        COMPANION_PORT = cached["services"]["companion"]["port"]
 
     if ATTEMPT_MRP:
         print("\nStep 1/2: MRP pairing (may not be supported on tvOS 15.4+)...")
@@ -277,7 +326,7 @@ async def cmd_pair_by_ip_direct(cfg):
             print("  (MRP not supported on this device — continuing with Companion only)")
         print()
 
-    print("Pairing Companion protocol (port 49153)...")
+    print(f"Pairing Companion protocol (port {COMPANION_PORT})...")
     comp_config = AppleTV(ip, name)
     comp_svc = MutableService(str(ip), Protocol.Companion, COMPANION_PORT, {})
     comp_svc._pairing_requirement = PairingRequirement.Optional
@@ -353,6 +402,7 @@ async def setup():
         print("\nOptions:")
         print("  [a] Scan and add / re-pair devices (mDNS)")
         print("  [i] Add / re-pair by IP address (cross-VLAN)")
+        print("  [s] Sweep subnet(s) for devices (cross-VLAN)")
         if devices:
             print("  [r] Remove a device")
         print("  [q] Quit / Done")
@@ -365,6 +415,8 @@ async def setup():
             await cmd_add_devices(cfg)
         elif choice == "i":
             await cmd_pair_by_ip_direct(cfg)
+        elif choice == "s":
+            await cmd_sweep_devices(cfg)
         elif choice == "r" and devices:
             cmd_remove_device(cfg)
         else:
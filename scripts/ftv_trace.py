@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+ftv_trace.py — Rank the slowest requests and stages in a daemon span trace.
+
+The daemon writes spans when started with FTV_TRACE=true or after a
+{"cmd": "trace", "args": ["on"]} request (see ftv_daemon.py).  Each request
+has one "request" span plus one span per stage it went through: receive,
+queue, dispatch, lock, acquire, discover, connect and device.  The same file
+also opens directly in chrome://tracing or https://ui.perfetto.dev.
+
+Usage:
+    python3 ftv_trace.py [trace.json ...] [--top N]
+
+With no file arguments, reads FTV_TRACE_PATH and its rotated backups.
+"""
+
+import collections
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ftv_daemon import TRACE_BACKUPS, TRACE_PATH  # noqa: E402
+
+
+def read_spans(paths):
+    """Yield span dicts from trace files, skipping the array bracket."""
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip().rstrip(",")
+                if not line or line in ("[", "]"):
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue   # torn last line of a file still being written
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def analyse(spans):
+    """Group spans by request; return (requests, per-stage durations in ms)."""
+    requests = {}
+    stages = collections.defaultdict(lambda: collections.defaultdict(float))
+    for span in spans:
+        key = (span["pid"], span["tid"])
+        if span["name"] == "request":
+            requests[key] = span
+        else:
+            stages[key][span["name"]] += span["dur"] / 1000
+    by_stage = collections.defaultdict(list)
+    for key in requests:
+        for stage, ms in stages[key].items():
+            by_stage[stage].append(ms)
+    return [(span, dict(stages[key])) for key, span in requests.items()], by_stage
+
+
+def main():
+    top = 10
+    argv = sys.argv[1:]
+    if "--top" in argv:
+        i = argv.index("--top")
+        top = int(argv[i + 1])
+        del argv[i:i + 2]
+    paths = argv or [
+        p for p in [f"{TRACE_PATH}.{i}" for i in range(TRACE_BACKUPS, 0, -1)] + [TRACE_PATH]
+        if os.path.exists(p)
+    ]
+    if not paths:
+        sys.exit(f"no trace files (looked for {TRACE_PATH})")
+
+    requests, by_stage = analyse(read_spans(paths))
+    if not requests:
+        sys.exit("no complete requests in trace")
+    requests.sort(key=lambda r: r[0]["dur"], reverse=True)
+
+    print(f"{len(requests)} requests; slowest {min(top, len(requests))}:")
+    for span, stages in requests[:top]:
+        args = span.get("args", {})
+        breakdown = "  ".join(
+            f"{stage} {ms:.1f}" for stage, ms in sorted(stages.items(), key=lambda s: -s[1])
+            if stage != "receive" or ms >= 0.1
+        )
+        status = "ok" if args.get("ok", True) else args.get("kind") or "error"
+        print(f"  {span['dur'] / 1000:9.1f} ms  {args.get('cmd', '?'):18s} "
+              f"{args.get('device') or '-':20s} {status:10s} {breakdown}")
+
+    print()
+    print(f"{'stage':10s} {'count':>7s} {'total ms':>11s} {'p50':>8s} {'p95':>8s} {'max':>8s}")
+    for stage, values in sorted(by_stage.items(), key=lambda s: -sum(s[1])):
+        values.sort()
+        print(f"{stage:10s} {len(values):7d} {sum(values):11.1f} "
+              f"{_percentile(values, 0.50):8.1f} {_percentile(values, 0.95):8.1f} "
+              f"{values[-1]:8.1f}")
+
+
+if __name__ == "__main__":
+    main()